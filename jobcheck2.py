@@ -4,9 +4,23 @@ import sys
 import subprocess
 import datetime 
 import re
-import os,glob,time
+import os,glob,time,stat
 import random
-from apscheduler.schedulers.blocking import BlockingScheduler
+import fnmatch
+import concurrent.futures
+import ctypes,ctypes.util
+import select,struct,errno,fcntl,signal
+import threading
+import asyncio,io
+import contextlib
+import enum
+import cProfile
+import getpass
+import collections,itertools
+import sqlite3
+import json
+import socket,socketserver,hashlib,tempfile
+import xml.etree.ElementTree as ET
 
 ##################################################
 # help funciton
@@ -49,157 +63,2598 @@ def nice_sec2str(x):
  
     return ss
 
+@contextlib.contextmanager
+def atomic_open(fname,mode='w'):
+    """ Open a temporary file that replaces fname when it is closed
+
+    A reader of fname sees either the old file or the new one, never
+    half of it.  Nothing is replaced if the block raises.
+
+    Args:
+        fname (string): the file to write
+        mode (string): the mode to open the temporary file with
+
+    """
+    tmp='{}.tmp{}'.format(fname,os.getpid())
+    try:
+        with open(tmp,mode) as fp:
+            yield fp
+        os.replace(tmp,fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+@contextlib.contextmanager
+def deadline(proc,comm,timeout=None):
+    """ Kill a process still running timeout seconds into the block
+
+    For the commands whose output is read while they run.
+
+    Args:
+        proc (Popen): the process
+        comm (list): its command, for the exception
+        timeout (float): seconds, None for no limit
+
+    Raises:
+        subprocess.TimeoutExpired: the process was killed
+
+    """
+    expired=[]
+    def kill():
+        expired.append(True)
+        proc.kill()
+    timer=None
+    if timeout is not None:
+        timer=threading.Timer(timeout,kill)
+        timer.daemon=True
+        timer.start()
+    try:
+        yield
+    except Exception:
+        if expired:
+            raise subprocess.TimeoutExpired(comm,timeout)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if expired:
+        raise subprocess.TimeoutExpired(comm,timeout)
+
+
+##################################################
+# metrics of a check
+###################################################
+class Metrics:
+    """ Timers and counters of one check
+
+    Wall time of each phase, number and time of the scheduler calls,
+    files opened, bytes read and folders visited.  write() saves them as
+    json and as a Prometheus textfile collector file.
+    """
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started=time.time()
+            self.seconds=None
+            self.phases=collections.OrderedDict()
+            self.commands={}  # label -> [calls, seconds]
+            self.files_opened=0
+            self.bytes_read=0
+            self.folders_visited=0
+
+    def add_phase(self,name,seconds):
+        with self._lock:
+            self.phases[name]=self.phases.get(name,0)+seconds
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        t0=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name,time.perf_counter()-t0)
+
+    # time a coroutine as a phase
+    async def timed(self,name,awaitable):
+        with self.phase(name):
+            return await awaitable
+
+    # a function timed as a phase, for threads
+    def timed_call(self,name,func,*args):
+        def call():
+            with self.phase(name):
+                return func(*args)
+        return call
+
+    @staticmethod
+    def label(comm):
+        if comm[0]=='qstat':
+            for flag in ('-j','-xml','-g'):
+                if flag in comm:
+                    return 'qstat '+flag
+        return os.path.basename(comm[0])
+
+    def add_command(self,comm,seconds):
+        label=self.label(comm)
+        with self._lock:
+            stat=self.commands.setdefault(label,[0,0.0])
+            stat[0]+=1
+            stat[1]+=seconds
+
+    @contextlib.contextmanager
+    def command(self,comm):
+        t0=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_command(comm,time.perf_counter()-t0)
+
+    def read_file(self,nbytes,opened=1):
+        with self._lock:
+            self.files_opened+=opened
+            self.bytes_read+=nbytes
+
+    def visit_folder(self,n=1):
+        with self._lock:
+            self.folders_visited+=n
+
+    def finish(self):
+        self.seconds=time.time()-self.started
+
+    def as_dict(self):
+        return {'started':self.started,
+                'seconds':self.seconds,
+                'phases':dict(self.phases),
+                'commands':{k:{'calls':v[0],'seconds':v[1]} 
+                            for k,v in self.commands.items()},
+                'files_opened':self.files_opened,
+                'bytes_read':self.bytes_read,
+                'folders_visited':self.folders_visited}
+
+    def prometheus(self):
+        lines=[]
+        def metric(name,kind,text,samples):
+            lines.append('# HELP jobcheck_{} {}'.format(name,text))
+            lines.append('# TYPE jobcheck_{} {}'.format(name,kind))
+            for labels,value in samples:
+                lines.append('jobcheck_{}{} {}'.format(name,labels,value))
+        metric('check_seconds','gauge','Wall time of the last check',
+               [('',self.seconds or 0)])
+        metric('check_timestamp_seconds','gauge','Start of the last check',
+               [('',self.started)])
+        metric('phase_seconds','gauge','Wall time of each phase',
+               [('{{phase="{}"}}'.format(k),v) 
+                for k,v in self.phases.items()])
+        metric('command_calls','gauge','Scheduler calls in the last check',
+               [('{{command="{}"}}'.format(k),v[0]) 
+                for k,v in self.commands.items()])
+        metric('command_seconds','gauge','Time spent in scheduler calls',
+               [('{{command="{}"}}'.format(k),v[1]) 
+                for k,v in self.commands.items()])
+        metric('files_opened','gauge','Job files opened',
+               [('',self.files_opened)])
+        metric('bytes_read','gauge','Bytes read from job files',
+               [('',self.bytes_read)])
+        metric('folders_visited','gauge','Folders listed in the walk',
+               [('',self.folders_visited)])
+        return '\n'.join(lines)+'\n'
+
+    def write(self,folder,name='jobcheck_metrics'):
+        """ Write name.json and name.prom into folder, each file is
+        replaced at once so a reader never sees half of it """
+        for ext,text in (('.json',json.dumps(self.as_dict(),indent=1)),
+                         ('.prom',self.prometheus())):
+            with atomic_open(os.path.join(folder,name+ext)) as fp:
+                fp.write(text)
+
+# the metrics of the current check
+METRICS=Metrics()
+
 
 ##################################################
 # collect information from job files
 ###################################################
-def jobid_from_begin_file(path='./'):
-    fname=os.path.join(path,'job.begin')
-    if not os.path.isfile(fname):
+# parsed job files, (kind,fname) -> (size,mtime,result), a file is
+# parsed again only when its size or mtime changes
+_parse_cache={}
+# the keys of _parse_cache asked since the last sweep_parse_cache
+_parse_used=set()
+
+def cached_parse(kind,fname,parser,st=None):
+    """ Parse a file once for each (size, mtime) of it
+
+    Args:
+        kind (string): what is parsed, a file can be parsed in several ways
+        fname (string): the file
+        parser (function): parser(fname) returns the result
+        st (tuple): (mtime_ns, size, inode) of the file if already
+            known, from a FolderProbe
+
+    Returns:
+        the result of the parser, None if the file does not exist
+
+    """
+    if st is None:
+        try:
+            st=os.stat(fname)
+        except OSError:
+            return None
+        st=(st.st_mtime_ns,st.st_size)
+    key=(kind,fname)
+    _parse_used.add(key)
+    old=_parse_cache.get(key)
+    if old and old[0]==st[1] and old[1]==st[0]:
+        return old[2]
+    result=parser(fname)
+    _parse_cache[key]=(st[1],st[0],result)
+    return result
+
+def sweep_parse_cache():
+    """ Forget the files not parsed since the last sweep
+
+    Called after a check of the whole tree, so the cache holds the files
+    of the folders that are still there and still read.
+    """
+    for key in set(_parse_cache)-_parse_used:
+        del _parse_cache[key]
+    _parse_used.clear()
+
+# the job files, in the order of their stats in a FolderProbe
+job_files=('job.begin','job.done','job.info')
+
+class FolderProbe(collections.namedtuple('FolderProbe',
+                                         'folder stats dat scripts')):
+    """ What one listing of a job folder tells
+
+    Attributes:
+        folder (string): the folder
+        stats (tuple): (mtime_ns, size, inode) of each of job_files,
+            None for a missing one
+        dat (bool): there is a *.dat output
+        scripts (tuple): the dwt*.job scripts, joined to the folder
+
+    """
+    __slots__=()
+
+    def stat(self,name):
+        return self.stats[job_files.index(name)]
+
+    # the signature of the job files kept in the scan state
+    @property
+    def signature(self):
+        return json.dumps(self.stats)
+
+def probe_folder(path='./'):
+    """ List a job folder once and stat only its job files
+
+    Args:
+        path (string): the folder
+
+    Returns:
+        FolderProbe: every file is missing if the folder cannot be read
+
+    """
+    try:
+        with os.scandir(path) as it:
+            entries=list(it)
+    except OSError:
+        entries=[]
+    return probe_entries(path,entries)
+
+# the FolderProbe of a folder from its os.scandir entries, for the
+# folders listed already
+def probe_entries(path,entries):
+    stats=[None]*len(job_files)
+    dat=False
+    scripts=[]
+    for entry in entries:
+        name=entry.name
+        if name in job_files:
+            try:
+                st=entry.stat()
+            except OSError:
+                continue
+            stats[job_files.index(name)]=(st.st_mtime_ns,st.st_size,
+                                          st.st_ino)
+        elif name.startswith('.'):
+            # hidden files do not match the globs
+            continue
+        elif name.endswith('.dat'):
+            dat=True
+        elif name.startswith('dwt') and name.endswith('.job'):
+            scripts.append(entry.path)
+    return FolderProbe(path,tuple(stats),dat,tuple(scripts))
+
+# parse a job file of a folder, with the stat of the probe if given
+def parse_job_file(kind,path,name,parser,probe=None):
+    fname=os.path.join(path,name)
+    if probe is None:
+        return cached_parse(kind,fname,parser)
+    st=probe.stat(name)
+    if st is None:
         return None
+    return cached_parse(kind,fname,parser,st)
+
+def tail_lines(fname,block=4096):
+    """ Yield the lines of a file from the last one to the first
+
+    Only the end of the file is read when the caller stops early.
+    """
+    with open(fname,'rb') as fp:
+        METRICS.read_file(0)
+        fp.seek(0,os.SEEK_END)
+        pos=fp.tell()
+        rest=b''
+        while pos>0:
+            n=min(block,pos)
+            pos-=n
+            fp.seek(pos)
+            METRICS.read_file(n,opened=0)
+            lines=(fp.read(n)+rest).split(b'\n')
+            rest=lines[0]
+            for line in reversed(lines[1:]):
+                yield line.decode("utf-8","replace")
+        yield rest.decode("utf-8","replace")
 
+def _last_match(fname,pattern):
+    for line in tail_lines(fname):
+        m=pattern.search(line)
+        if m:
+            return m.group(1)
+    return None
+
+begin_pattern=re.compile(r'Your job (\d+)')
+done_pattern=re.compile(r'^(\d+) ')
+
+def _read_ids(fname,pattern):
     idxes=[]
+    nbytes=0
     with open(fname) as fp:
         for line in fp:
-            m=re.search(r'Your job (\d+)',line)
+            nbytes+=len(line)
+            m=pattern.search(line)
             if m:
                 idxes.append(m.group(1))
-    
+    METRICS.read_file(nbytes)
     return idxes
+
+def jobid_from_begin_file(path='./',probe=None):
+    idxes=parse_job_file('ids',path,'job.begin',
+                         lambda f:_read_ids(f,begin_pattern),probe)
+    if idxes is None:
+        return None
+    return list(idxes)
     
 
-def jobid_from_done_file(path='./'):
-    fname=os.path.join(path,'job.done')
-    if not os.path.isfile(fname):
+def jobid_from_done_file(path='./',probe=None):
+    idxes=parse_job_file('ids',path,'job.done',
+                         lambda f:_read_ids(f,done_pattern),probe)
+    if idxes is None:
         return None
+    return list(idxes)    
 
-    idxes=[]
-    with open(fname) as fp:
-        for line in fp:
-            m=re.search(r'^(\d+) ',line)
-            if m:
-                idxes.append(m.group(1))
-    
-    return idxes    
+# the last job id in job.begin, read from the end of the file
+def last_begin_id(path='./',probe=None):
+    return parse_job_file('last',path,'job.begin',
+                          lambda f:_last_match(f,begin_pattern),probe)
 
+# the last job id in job.done, read from the end of the file
+def last_done_id(path='./',probe=None):
+    return parse_job_file('last',path,'job.done',
+                          lambda f:_last_match(f,done_pattern),probe)
 
-def is_finished_from_job_file(path='./'):
-    idx1=jobid_from_begin_file(path)
-    idx2=jobid_from_done_file(path)
-    if idx1 and idx2 and idx1[-1] in idx2:
+# probe: the FolderProbe of the folder, to skip the stats of the files
+def is_finished_from_job_file(path='./',probe=None):
+    idx1=last_begin_id(path,probe)
+    if not idx1:
+        return False
+    # the last job is usually the last one in job.done as well
+    if last_done_id(path,probe)==idx1:
+        return True
+    idx2=jobid_from_done_file(path,probe)
+    if idx2 and idx1 in idx2:
         return True
     else:
         return False
 
 
-def is_finished_from_dat_file(path='./'):
-    cwd = os.getcwd()
-    os.chdir(path)    
-    files= glob.glob("*.dat")
-    os.chdir(cwd)
+def is_finished_from_dat_file(path='./',probe=None):
+    if probe is not None:
+        return probe.dat
+    files= glob.glob(os.path.join(glob.escape(path),"*.dat"))
     if files:
         return True
     else:
         return False
 
 def job_done_id(path='./'):
-    idx2=jobid_from_done_file(path)
-    return idx2[-1]
+    return last_done_id(path)
+
+def _info_time(line):
+    ss=line.split()
+    newline="{}/{}/{} {}".format(ss[1],ss[2],ss[5],ss[3])
+    return datetime.datetime.strptime(newline, "%b/%d/%Y %H:%M:%S")
+
+def _read_info(fname):
+    # a begin (end) record is a line of + (-), a date and a line
+    # starting with the job id
+    times={}
+    with open(fname) as f:
+        lines=[line.rstrip('\r\n') for line in f]
+    METRICS.read_file(sum(len(line)+1 for line in lines))
+    for i in range(len(lines)-2):
+        mark=lines[i]
+        if not mark or mark[0] not in '+-' or mark.strip(mark[0]):
+            continue
+        m=re.match(r'(\d+)',lines[i+2])
+        if not m:
+            continue
+        try:
+            t=_info_time(lines[i+1])
+        except (ValueError,IndexError):
+            continue
+        btimes,etimes=times.setdefault(m.group(1),([],[]))
+        if mark[0]=='+':
+            btimes.append(t)
+        else:
+            etimes.append(t)
+    return times
+
+def job_info_times(path='./',probe=None):
+    """ Begin and end times of all the jobs in job.info
+
+    job.info is read in one pass and kept until it changes.
+
+    Args:
+        path (string): the job folder
+        probe (FolderProbe): the listing of the folder, if taken
+
+    Returns:
+        dict: job id -> ([begin times],[end times]), empty if there is
+            no job.info
+
+    """
+    times=parse_job_file('info',path,'job.info',_read_info,probe)
+    if times is None:
+        return {}
+    return times
     
 # collect info from job.info
-def read_job_info(idx,path='./'):
-    info=(idx,)
-    fname=os.path.join(path,"job.info")
-    if os.path.isfile(fname):
-        with open(fname) as f:
-            lines=f.readlines()
-    else:
-        return info
+def read_job_info(idx,path='./',probe=None):
+    btimes,etimes=job_info_times(path,probe).get(idx,([],[]))
+    return (idx,)+tuple(btimes)+tuple(etimes)
 
-    # get btime, job begin time
-    for i in range(len(lines)-2):
-        matchObj1=re.match( r'^[+]+$', lines[i], re.M|re.I)
-        matchObj2=re.match( '^'+idx, lines[i+2], re.M|re.I)
-        if matchObj1 and matchObj2:
-            line=lines[i+1]
-            ss=line.split()
-            newline="{}/{}/{} {}".format(ss[1],ss[2],ss[5],ss[3])
-            btime=datetime.datetime.strptime(newline, "%b/%d/%Y %H:%M:%S")
-            info+=(btime,)
 
-    for i in range(len(lines)-2):
-        matchObj1=re.match( r'^[-]+$', lines[i], re.M|re.I)
-        matchObj2=re.match( '^'+idx, lines[i+2], re.M|re.I)
-        if matchObj1 and matchObj2:
-            line=lines[i+1]
-            ss=line.split()
-            newline="{}/{}/{} {}".format(ss[1],ss[2],ss[5],ss[3])
-            etime=datetime.datetime.strptime(newline, "%b/%d/%Y %H:%M:%S")
-            info+=(etime,)
+##################################################
+# scan state kept between ticks
+###################################################
+class ScanState:
+    """ The last classification of every folder without a queued job
+
+    The state lives in a sqlite file at the scan root.  A folder whose
+    job files have the same signature as last time keeps its old
+    status, so its job files are not read again.
+    """
+    def __init__(self,path,fname='.jobcheck.db'):
+        self.fname=os.path.join(path,fname)
+        self.db=sqlite3.connect(self.fname)
+        self.db.execute('CREATE TABLE IF NOT EXISTS folders ('
+                        'folder TEXT PRIMARY KEY, status TEXT, '
+                        'sig TEXT, message TEXT)')
+        self.rows={}
+        for folder,status,sig,message in self.db.execute(
+                'SELECT folder,status,sig,message FROM folders'):
+            self.rows[folder]=(status,sig,message)
+        self.changed={}
+
+    # (status,message) of a folder if the signature has not changed
+    def get(self,folder,sig):
+        row=self.rows.get(folder)
+        if row is None or row[1]!=sig:
+            return None
+        return row[0],row[2]
 
-    return info
+    def put(self,folder,status,sig,message=''):
+        row=(status,sig,message)
+        if self.rows.get(folder)!=row:
+            self.rows[folder]=row
+            self.changed[folder]=row
+
+    def forget(self,folder):
+        if self.rows.pop(folder,None) is not None:
+            self.changed[folder]=None
+
+    def commit(self):
+        with self.db:
+            self.db.executemany(
+                'DELETE FROM folders WHERE folder=?',
+                [(f,) for f,row in self.changed.items() if row is None])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO folders VALUES (?,?,?,?)',
+                [(f,)+row for f,row in self.changed.items() 
+                 if row is not None])
+        self.changed={}
+
+    def close(self):
+        self.db.close()
 
 
 ##################################################
 # actions
 ###################################################
-def kill_job(idx):
-    comm=["qdel",idx]
-    res = subprocess.check_output(comm).decode("utf-8").rstrip()
-    print("Killing message: "+res)
-    time.sleep(3)
+# kill one job, waiting until it left the queue instead of a fixed
+# time; backends: the Backends the job may be in, Grid Engine if None;
+# return the outcome, see KillQueue
+def kill_job(idx,backends=None,timeout=60):
+    if backends is None:
+        backends=Backends(SgeBackend())
+    backends.kill(idx)
+    result=backends.flush(timeout)[idx]
+    print("Killing message: job {} {}".format(idx,result))
+    return result
+
+####################################
+class KillQueue:
+    """ qdel requests collected during a walk and sent in batches
+
+    The jobs are killed with a few qdel calls, then the queue is asked
+    until they are gone or the deadline has passed.  The outcome of a
+    job is one of 'killed', 'gone' (it was not in the queue any more),
+    'failed' (qdel refused it) or 'timeout'.
+    """
+    def __init__(self,chunk=200,deadline=60,interval=2):
+        self.chunk=chunk
+        self.deadline=deadline
+        self.interval=interval
+        self.requests=collections.OrderedDict()  # idx -> Fjob or None
+
+    def __len__(self):
+        return len(self.requests)
+
+    def request(self,idx,fjob=None):
+        self.requests[idx]=fjob
+
+    def flush(self,timeout=60):
+        """ Kill all the requested jobs
+
+        Args:
+            timeout (float): seconds before a qdel or qstat call is
+                given up
+
+        Returns:
+            dict: job id -> outcome
+
+        """
+        outcome={}
+        for chunk in self._chunks():
+            try:
+                with METRICS.command(["qdel"]):
+                    res=subprocess.check_output(["qdel"]+chunk,
+                                                stderr=subprocess.STDOUT,
+                                                timeout=timeout)
+            except subprocess.CalledProcessError as e:
+                # some jobs are refused, the others are still killed
+                res=e.output or b''
+            except subprocess.TimeoutExpired as e:
+                print("Killing message: qdel failed, {!r}".format(e))
+                continue
+            self._read_qdel(res,chunk,outcome)
+        invalidate_queries()
+
+        # wait for the others to leave the queue
+        waiting=set(idx for idx in self.requests if idx not in outcome)
+        end=time.time()+self.deadline
+        while waiting:
+            try:
+                alive=take_snapshot(fresh=True,timeout=timeout).ids()
+            except (OSError,subprocess.SubprocessError):
+                alive=waiting
+            waiting=self._confirm(waiting,alive,outcome)
+            if not waiting or time.time()>=end:
+                break
+            time.sleep(self.interval)
+        return self._finish(waiting,outcome)
+
+    async def aflush(self,timeout=60):
+        """ Kill all the requested jobs with asyncio subprocesses
+
+        Returns:
+            dict: job id -> outcome
+
+        """
+        outcome={}
+        chunks=self._chunks()
+        results=await asyncio.gather(
+            *(run_command(["qdel"]+chunk,timeout,check=False,
+                          stderr=subprocess.STDOUT) for chunk in chunks),
+            return_exceptions=True)
+        for chunk,res in zip(chunks,results):
+            if isinstance(res,Exception):
+                print("Killing message: qdel failed, {!r}".format(res))
+                continue
+            self._read_qdel(res,chunk,outcome)
+        invalidate_queries()
+
+        waiting=set(idx for idx in self.requests if idx not in outcome)
+        end=time.time()+self.deadline
+        while waiting:
+            try:
+                snapshot=await async_take_snapshot(timeout=timeout,
+                                                   fresh=True)
+                alive=snapshot.ids()
+            except (OSError,subprocess.CalledProcessError,
+                    asyncio.TimeoutError):
+                alive=waiting
+            waiting=self._confirm(waiting,alive,outcome)
+            if not waiting or time.time()>=end:
+                break
+            await asyncio.sleep(self.interval)
+        return self._finish(waiting,outcome)
+
+    def _chunks(self):
+        ids=list(self.requests)
+        return [ids[i:i+self.chunk] for i in range(0,len(ids),self.chunk)]
+
+    # jobs qdel refused or did not know
+    def _read_qdel(self,res,chunk,outcome):
+        res=res.decode("utf-8","replace")
+        wanted=set(chunk)
+        for line in res.splitlines():
+            print("Killing message: "+line)
+            for idx in re.findall(r'\d+',line):
+                if idx not in wanted:
+                    continue
+                if 'not exist' in line:
+                    outcome[idx]='gone'
+                elif 'denied' in line:
+                    outcome[idx]='failed'
+
+    # the jobs still in the queue
+    def _confirm(self,waiting,alive,outcome):
+        for idx in waiting-alive:
+            outcome[idx]='killed'
+        return waiting&alive
+
+    def _finish(self,waiting,outcome):
+        for idx in waiting:
+            outcome[idx]='timeout'
+        for idx,fjob in self.requests.items():
+            if fjob is not None:
+                fjob.kill_result=outcome[idx]
+        self.requests=collections.OrderedDict()
+        return outcome
+
+####################################
+def touch(path='./'):
+    basedir = os.path.dirname(path)
+    if not os.path.exists(basedir):
+        os.makedir(basedir)
+
+    with open(path, 'a'):
+        os.utime(path, None)
+
+####################################
+# submit one job script, qsub is run in the job folder (that is the
+# sge_o_workdir of the job) and -wd makes it the working directory
+# return the job id (None if not understood) and the qsub message
+def qsub(fname,server,path='./'):
+    path=os.path.abspath(path)
+    comm=qsub_command(fname,server,path)
+    try:
+        with METRICS.command(comm):
+            line=subprocess.check_output(comm,cwd=path).decode("utf-8")
+    finally:
+        invalidate_queries()
+    return qsub_jobid(line),line
+
+def qsub_command(fname,server,path):
+    return ["qsub","-wd",path,"-q",server,os.path.basename(fname)]
+
+def qsub_jobid(line):
+    m=re.search(r'Your job(?:-array)? (\d+)',line)
+    return m.group(1) if m else None
+
+# write down a submission in job.begin, and in q if given; manifest:
+# the root of the manifest the folder is added to, None for none, True
+# to look for it above the folder (a stat of each parent)
+def record_submission(path,server,idx,line,q=None,status='qw',
+                      manifest=True):
+    print(line)
+    with open(os.path.join(path,"job.begin"), "a+") as f:
+        f.write(line)
+    if manifest is True:
+        register_folders([path])
+    elif manifest is not None:
+        register_folders([path],manifest)
+    if idx and q is not None:
+        q.append(Qjob(idx,status,datetime.datetime.now(),
+                      server,'1',os.path.abspath(path)))
+
+def job_scripts(path='./',probe=None):
+    if probe is not None:
+        return list(probe.scripts)
+    return glob.glob(os.path.join(glob.escape(path),"dwt*.job"))
+
+# both submit functions return [(idx,server)] of the new jobs
+# probe: the FolderProbe of the folder, its scripts are submitted
+def submit_job(server="all.q",smp=None,path='./',probe=None):
+    files=job_scripts(path,probe)
+    submitted=[]
+    for fname in  files:
+        idx,line=qsub(fname,server,path)
+        record_submission(path,server,idx,line)
+        if idx:
+            submitted.append((idx,server))
+    return submitted
+
+####################################
+# backends: the Backends the jobs are sent to, each job to the one
+# that takes it for its expected running time (runtime, seconds),
+# qsub right away if None; the jobs waiting in a SubmitQueue are not
+# returned here
+# manifest: as in record_submission
+def submit_job_based_Q(q=None,path='./',backends=None,probe=None,
+                       runtime=None,manifest=True):
+    if backends is None:
+        backends=Backends(SgeBackend())
+    files=job_scripts(path,probe)
+    submitted=[]
+    for fname in  files:
+        if q:
+            backend=backends.pick(fname,runtime,q.expected_wait())
+            server=backend.server(q)
+            if server:
+                result=backend.submit(fname,server,path)
+                if result is None:
+                    q.reserve(server)
+                    continue
+                idx,line=result
+                record_submission(path,server,idx,line,q,backend.status,
+                                  manifest)
+                if idx:
+                    submitted.append((idx,server))
+    return submitted
+
+class SubmitQueue:
+    """ qsub work items sent by a few threads at a limited rate
+
+    In array mode the items with the same queue and the same job script
+    header are sent as one array job, one task for each folder.
+
+    Args:
+        workers (int): how many qsub can run at the same time
+        rate (float): at most this many qsub a second, 0 for no limit
+        array_dir (string): the folder for the task lists and scripts
+            of the array jobs, None to submit every item by itself
+
+    """
+    def __init__(self,workers=4,rate=10,array_dir=None):
+        self.workers=max(workers,1)
+        self.rate=rate
+        self.array_dir=array_dir
+        self.items=[]  # (folder,script,server)
+        self._lock=threading.Lock()
+        self._next=0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self,folder,script,server):
+        self.items.append((folder,script,server))
+
+    # seconds to wait before the next qsub
+    def _turn(self):
+        if not self.rate:
+            return 0
+        with self._lock:
+            now=time.time()
+            start=max(now,self._next)
+            self._next=start+1.0/self.rate
+        return start-now
+
+    def _wait_turn(self):
+        delay=self._turn()
+        if delay>0:
+            time.sleep(delay)
+
+    # the items sent by each qsub, in the order they were put
+    def _batches(self):
+        items=self.items
+        self.items=[]
+        if self.array_dir is None:
+            return [[item] for item in items]
+        groups=collections.OrderedDict()
+        for item in items:
+            key=(item[2],)+script_header(item[1])
+            groups.setdefault(key,[]).append(item)
+        return list(groups.values())
+
+    # the qsub command of a batch and where to run it
+    def _command(self,batch):
+        if len(batch)==1:
+            folder,script,server=batch[0]
+            path=os.path.abspath(folder)
+            return qsub_command(script,server,path),path,None
+        comm,listfile=array_command(self.array_dir,batch)
+        return comm,self.array_dir,listfile
+
+    def _submit(self,batch):
+        self._wait_turn()
+        try:
+            comm,path,listfile=self._command(batch)
+            with METRICS.command(comm):
+                line=subprocess.check_output(comm,cwd=path).decode("utf-8")
+        except (OSError,subprocess.CalledProcessError) as e:
+            return [(item,None,None,e) for item in batch]
+        finally:
+            invalidate_queries()
+        return self._results(batch,listfile,line)
+
+    def _results(self,batch,listfile,line):
+        if listfile is None:
+            return [(batch[0],qsub_jobid(line),line,None)]
+        return array_results(batch,listfile,line)
+
+    def run(self):
+        """ Submit everything in the queue
+
+        Yields:
+            tuple: ((folder,script,server),idx,message,error) for every
+                item, idx is job.task for a task of an array job
+        """
+        batches=self._batches()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for results in pool.map(self._submit,batches):
+                yield from results
+
+    async def arun(self,timeout=60):
+        """ Submit everything in the queue with asyncio subprocesses
+
+        Returns:
+            list: the same tuples as run()
+        """
+        batches=self._batches()
+        slots=asyncio.Semaphore(self.workers)
+
+        async def submit(batch):
+            async with slots:
+                delay=self._turn()
+                if delay>0:
+                    await asyncio.sleep(delay)
+                try:
+                    comm,path,listfile=self._command(batch)
+                    out=await run_command(comm,timeout,cwd=path)
+                except (OSError,subprocess.CalledProcessError,
+                        asyncio.TimeoutError) as e:
+                    return [(item,None,None,e) for item in batch]
+                finally:
+                    invalidate_queries()
+            return self._results(batch,listfile,out.decode("utf-8"))
+
+        results=await asyncio.gather(*(submit(batch) for batch in batches))
+        return [result for batch in results for result in batch]
+
+####################################
+# array jobs: task n of an array job runs line n of its task list, a
+# job folder and its job script, and the list is kept as <job id>.list
+# in the array folder so the tasks can be mapped back to their folders
+array_folder='.jobcheck_arrays'
+
+def array_dir(path):
+    return os.path.join(os.path.abspath(path),array_folder)
+
+array_script="""#!/bin/bash
+#$ -S /bin/bash
+{directives}# the task runs line $SGE_TASK_ID of the task list given as $1: a
+# job folder and its job script, separated by a tab
+line=$(sed -n "${{SGE_TASK_ID}}p" "$1")
+cd "${{line%%\t*}}" || exit 100
+script="${{line#*\t}}"
+exec {shell} "./$script" >"$script.o$JOB_ID.$SGE_TASK_ID" \\
+    2>"$script.e$JOB_ID.$SGE_TASK_ID"
+"""
+
+# the options of the array job itself, not taken from the job scripts
+_array_options=('-N','-o','-e','-j','-cwd','-wd','-t','-S')
+
+def script_header(script):
+    """ The shell and the qsub options (#$ lines) of a job script
+
+    Args:
+        script (string): the job script
+
+    Returns:
+        tuple: (shell, directive lines), /bin/bash if there is no #!
+
+    """
+    shell='/bin/bash'
+    directives=[]
+    try:
+        with open(script) as fp:
+            for n,line in enumerate(fp):
+                if n==0 and line.startswith('#!'):
+                    shell=line[2:].strip() or shell
+                elif line.startswith('#$'):
+                    options=line[2:].split()
+                    if options and options[0] not in _array_options:
+                        directives.append(line.rstrip('\n')+'\n')
+    except OSError:
+        pass
+    return (shell,)+tuple(directives)
+
+_array_count=itertools.count()
+
+def array_command(array_dir,items):
+    """ Write the task list and the script of an array job
+
+    Args:
+        array_dir (string): where to write them
+        items (list): (folder,script,server) of the tasks, all with the
+            same queue and script header
+
+    Returns:
+        tuple: (the qsub command, the task list)
+
+    """
+    os.makedirs(array_dir,exist_ok=True)
+    folder,script,server=items[0]
+    stem=os.path.join(array_dir,'{}_{}_{}'.format(
+        datetime.datetime.now().strftime('%Y%m%d%H%M%S'),os.getpid(),
+        next(_array_count)))
+    with open(stem+'.list','w') as fp:
+        for folder,name,server in items:
+            fp.write('{}\t{}\n'.format(os.path.abspath(folder),
+                                       os.path.basename(name)))
+    header=script_header(script)
+    with open(stem+'.sh','w') as fp:
+        fp.write(array_script.format(shell=header[0],
+                                     directives=''.join(header[1:])))
+    comm=['qsub','-wd',array_dir,'-q',server,'-t','1-{}'.format(len(items)),
+          '-N',os.path.basename(script),stem+'.sh',stem+'.list']
+    return comm,stem+'.list'
+
+def array_results(items,listfile,line):
+    """ The results of the tasks of a submitted array job
+
+    The task list is linked as <job id>.list for array_task_folder.
+
+    Returns:
+        list: ((folder,script,server),job.task,message,None) of every
+            task, the message is the one written into its job.begin
+
+    """
+    idx=qsub_jobid(line)
+    if idx is None:
+        return [(item,None,line,None) for item in items]
+    link=os.path.join(os.path.dirname(listfile),idx+'.list')
+    if os.path.lexists(link):
+        os.remove(link)
+    os.link(listfile,link)
+    results=[]
+    for n,item in enumerate(items,1):
+        task=task_id(idx,str(n))
+        results.append((item,task,'Your job {} ("{}") has been submitted'
+                        '\n'.format(task,os.path.basename(item[1])),None))
+    return results
+
+def _read_array_list(fname):
+    with open(fname) as fp:
+        lines=[line.rstrip('\n').split('\t')[0] for line in fp]
+    METRICS.read_file(sum(len(line)+1 for line in lines))
+    return lines
+
+def array_task_folder(workdir,idx):
+    """ The job folder of a task of an array job sent by SubmitQueue
+
+    Args:
+        workdir (string): the working folder of the job in the queue
+        idx (string): the job id, job.task for a task
+
+    Returns:
+        string: the folder of the task, workdir for any other job
+
+    """
+    if workdir is None or '.' not in idx:
+        return workdir
+    number,task=idx.split('.',1)
+    folders=cached_parse('array',os.path.join(workdir,number+'.list'),
+                         _read_array_list)
+    if not folders or not task.isdigit() or \
+       not 0<int(task)<=len(folders):
+        return workdir
+    return folders[int(task)-1]
+
+####################################
+# the local lane: short jobs run on this machine instead of waiting in
+# the queue, with the same job.begin, job.info and job.done as the
+# cluster jobs so their folders are classified the same way
+local_queue='local'
+
+# the local jobs get ids far above those of the cluster
+local_first_id=900000000
+
+# run as bash -c local_script jobcheck-local <id> <script> <slots>
+# <shell> in the job folder
+local_script="""
+stamp() { printf '%s\\n%s\\n%s\\n' "$1" "$(LC_ALL=C date)" "$2" >>job.info; }
+stamp ++++++++++++++++++++ "$1 $(hostname)"
+JOB_ID=$1 NSLOTS=$3 SGE_O_WORKDIR=$PWD $4 "./$2" >"$2.o$1" 2>"$2.e$1"
+status=$?
+stamp -------------------- "$1"
+[ $status -eq 0 ] && echo "$1 done" >>job.done
+exit $status
+"""
+
+# the slots a job script asks for with #$ -pe <name> <n>, 1 if none
+def script_slots(script):
+    for line in script_header(script)[1:]:
+        m=re.search(r'-pe\s+\S+\s+(\d+)',line)
+        if m:
+            return int(m.group(1))
+    return 1
+
+class LocalBackend:
+    """ Run job scripts on the spare cores of this machine
+
+    A backend next to SgeBackend, see Backends: submit() starts a job
+    at once, flush() stops the jobs asked with kill() and records()
+    gives the jobs as queue records, running in the queue 'local'.
+    The jobs are detached from jobcheck and kept in a json file at the
+    scan root, so the next check still sees them.
+
+    Args:
+        path (string): the scan root
+        cores (int): the most cores the local jobs use together
+        fname (string): the json file in path
+
+    """
+    # the status of a job just submitted
+    status='r'
+
+    def __init__(self,path,cores=1,fname='.jobcheck_local.json'):
+        self.fname=os.path.join(path,fname)
+        self.cores=cores
+        self.next=local_first_id
+        # idx -> [folder, script, pid, start, slots]
+        self.jobs={}
+        self.procs={}   # idx -> Popen of the jobs started here
+        self.requests=collections.OrderedDict()  # idx -> Fjob or None
+        try:
+            with open(self.fname) as fp:
+                data=json.load(fp)
+            self.next=data['next']
+            self.jobs=data['jobs']
+        except (OSError,ValueError,KeyError):
+            pass
+        self.poll()
+
+    def owns(self,idx):
+        return job_number(idx) in self.jobs
+
+    def _alive(self,idx,pid):
+        proc=self.procs.get(idx)
+        if proc is not None:
+            return proc.poll() is None
+        try:
+            # a job started by this process may be a zombie by now
+            if os.waitpid(pid,os.WNOHANG)[0]:
+                return False
+        except ChildProcessError:
+            pass
+        if os.path.isdir('/proc/self'):
+            try:
+                with open('/proc/{}/cmdline'.format(pid),'rb') as fp:
+                    args=fp.read().split(b'\0')
+            except OSError:
+                return False
+            # the pid may belong to another process by now, the
+            # command line is empty while a process starts
+            if args!=[b'']:
+                return idx.encode() in args
+        try:
+            os.kill(pid,0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    # forget the jobs that have ended
+    def poll(self):
+        for idx,job in list(self.jobs.items()):
+            if not self._alive(idx,job[2]):
+                del self.jobs[idx]
+                self.procs.pop(idx,None)
+
+    def free_cores(self):
+        return self.cores-sum(job[4] for job in self.jobs.values())
+
+    def takes(self,script,runtime,wait):
+        """ Whether a job should run here rather than in the queue
+
+        Args:
+            script (string): the job script
+            runtime (float): its expected running time, seconds
+            wait (float): its expected wait in the queue, seconds
+
+        Returns:
+            bool: True if it is expected to end here before it would
+            start in the queue and there are cores for it
+
+        """
+        if runtime is None or wait is None or runtime>=wait:
+            return False
+        self.poll()
+        return script_slots(script)<=self.free_cores()
+
+    def server(self,q):
+        return local_queue
+
+    def submit(self,script,server=local_queue,path='./'):
+        path=os.path.abspath(path)
+        idx=str(self.next)
+        self.next+=1
+        name=os.path.basename(script)
+        slots=script_slots(script)
+        comm=['bash','-c',local_script,'jobcheck-local',idx,name,
+              str(slots),script_header(script)[0]]
+        with METRICS.command(['local']):
+            proc=subprocess.Popen(comm,cwd=path,stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL,
+                                  start_new_session=True)
+        self.procs[idx]=proc
+        self.jobs[idx]=[path,name,proc.pid,time.time(),slots]
+        return idx,'Your job {} ("{}") has been submitted\n'.format(idx,name)
+
+    # the jobs are started in submit, none is left for run
+    def run(self):
+        return []
+
+    async def arun(self,timeout=60):
+        return []
+
+    def kill(self,idx,fjob=None):
+        self.requests[idx]=fjob
+
+    # stop the jobs asked with kill, the outcomes are those of KillQueue
+    def flush(self,timeout=60):
+        outcome={idx:self._stop(idx) for idx in self.requests}
+        for idx,fjob in self.requests.items():
+            if fjob is not None:
+                fjob.kill_result=outcome[idx]
+        self.requests=collections.OrderedDict()
+        return outcome
+
+    async def aflush(self,timeout=60):
+        return self.flush(timeout)
+
+    def _stop(self,idx):
+        job=self.jobs.pop(idx,None)
+        if job is None or not self._alive(idx,job[2]):
+            return 'gone'
+        try:
+            # the job runs in its own session, all of it is stopped
+            os.killpg(job[2],signal.SIGTERM)
+        except ProcessLookupError:
+            return 'gone'
+        except PermissionError:
+            return 'failed'
+        print("Killing message: local job {} stopped".format(idx))
+        return 'killed'
+
+    # the running jobs as queue records
+    def records(self):
+        return [Qrecord(idx,'r',datetime.datetime.fromtimestamp(job[3]),
+                        local_queue,str(job[4]),job[1],None)
+                for idx,job in self.jobs.items()]
+
+    # the working folders of the jobs, as known to aget_folders
+    def folders(self):
+        return {idx:job[0] for idx,job in self.jobs.items()}
+
+    # a snapshot of the queue with the local jobs in it
+    def merge(self,snapshot):
+        jobs=[job for job in snapshot.jobs if job.server!=local_queue]
+        return Qsnapshot(tuple(jobs+self.records()),snapshot.time)
+
+    def save(self):
+        with atomic_open(self.fname) as fp:
+            json.dump({'next':self.next,'jobs':self.jobs},fp)
+
+####################################
+# the backends: where the jobs of a check run.  A backend has
+#   owns(idx)        whether a job id is one of its jobs
+#   takes(script,runtime,wait) whether it should run a job expected to
+#                    run runtime seconds and to wait wait in the queue
+#   server(q)        the queue to send a job to, None if all are full
+#   submit(script,server,path)  (idx,message), or None if the job is
+#                    only queued for run()/arun()
+#   run(), arun(timeout)  send the queued jobs, the results of
+#                    SubmitQueue.run
+#   kill(idx,fjob)   ask to stop a job
+#   flush(timeout), aflush(timeout)  stop the jobs asked, job id ->
+#                    outcome as in KillQueue
+#   merge(snapshot)  the queue snapshot with its jobs in it
+#   records()        its jobs as queue records
+#   folders()        job id -> working folder of the jobs it knows
+#   save()           keep its state for the next check
+class SgeBackend:
+    """ Run job scripts in Grid Engine
+
+    The kills are sent in batches by a KillQueue, the submissions by a
+    SubmitQueue, or one qsub at a time if there is none.
+
+    Args:
+        kills (KillQueue): for the qdel, a new one if None
+        submits (SubmitQueue): for the qsub, None to submit at once
+
+    """
+    status='qw'
+
+    def __init__(self,kills=None,submits=None):
+        self.kills=kills if kills is not None else KillQueue()
+        self.submits=submits
+
+    @property
+    def requests(self):
+        return self.kills.requests
+
+    # the other backends have ids above those of the cluster
+    def owns(self,idx):
+        return int(job_number(idx))<local_first_id
+
+    # any job can wait in the queue
+    def takes(self,script,runtime,wait):
+        return True
+
+    def server(self,q):
+        return q.available_server()
+
+    def submit(self,script,server,path='./'):
+        if self.submits is None:
+            return qsub(script,server,path)
+        self.submits.put(path,script,server)
+        return None
+
+    def run(self):
+        if self.submits is None:
+            return []
+        return self.submits.run()
+
+    async def arun(self,timeout=60):
+        if self.submits is None:
+            return []
+        return await self.submits.arun(timeout)
+
+    def kill(self,idx,fjob=None):
+        self.kills.request(idx,fjob)
+
+    def flush(self,timeout=60):
+        return self.kills.flush(timeout)
+
+    async def aflush(self,timeout=60):
+        return await self.kills.aflush(timeout)
+
+    # the snapshot is taken from this queue
+    def merge(self,snapshot):
+        return snapshot
+
+    def records(self,timeout=None):
+        return list(take_snapshot(timeout=timeout).jobs)
+
+    # qstat -j finds the folders of these jobs
+    def folders(self):
+        return {}
+
+    def save(self):
+        pass
+
+class Backends:
+    """ The backends of a check
+
+    A job is sent to the first backend that takes it and killed by the
+    one that owns its id, Grid Engine comes last and takes the rest.
+
+    Args:
+        *backends: SgeBackend, LocalBackend..., None for none
+
+    """
+    def __init__(self,*backends):
+        self.backends=[backend for backend in backends
+                       if backend is not None]
+
+    def pick(self,script,runtime,wait):
+        for backend in self.backends:
+            if backend.takes(script,runtime,wait):
+                return backend
+        return self.backends[-1]
+
+    def owner(self,idx):
+        for backend in self.backends:
+            if backend.owns(idx):
+                return backend
+        return self.backends[-1]
+
+    def kill(self,idx,fjob=None):
+        self.owner(idx).kill(idx,fjob)
+
+    # the kills asked: job id -> Fjob or None
+    def requests(self):
+        requests=collections.OrderedDict()
+        for backend in self.backends:
+            requests.update(backend.requests)
+        return requests
+
+    def flush(self,timeout=60):
+        outcome={}
+        for backend in self.backends:
+            if backend.requests:
+                outcome.update(backend.flush(timeout))
+        return outcome
+
+    async def aflush(self,timeout=60):
+        outcome={}
+        for result in await asyncio.gather(
+                *(backend.aflush(timeout) for backend in self.backends
+                  if backend.requests)):
+            outcome.update(result)
+        return outcome
+
+    def run(self):
+        for backend in self.backends:
+            yield from backend.run()
+
+    async def arun(self,timeout=60):
+        results=await asyncio.gather(
+            *(backend.arun(timeout) for backend in self.backends))
+        return [result for found in results for result in found]
+
+    def merge(self,snapshot):
+        for backend in self.backends:
+            snapshot=backend.merge(snapshot)
+        return snapshot
+
+    def folders(self):
+        known={}
+        for backend in self.backends:
+            known.update(backend.folders())
+        return known
+
+    def save(self):
+        for backend in self.backends:
+            backend.save()
+
+# the backends of a check of the tree at path: Grid Engine with a
+# SubmitQueue of qsub_workers threads sending qsub_rate jobs a second
+# (array jobs if array), and the local lane if local_cores
+def make_backends(path,local_cores=0,qsub_workers=4,qsub_rate=10,
+                  array=False):
+    submits=SubmitQueue(qsub_workers,qsub_rate,
+                        array_dir(path) if array else None)
+    local=LocalBackend(path,local_cores) if local_cores else None
+    return Backends(local,SgeBackend(KillQueue(),submits))
+
+####################################
+def bulk_job_folders(idxes,chunk=500,timeout=None):
+    """ Find the working folder of many jobs with a few qstat calls
+
+    The job ids are passed to ``qstat -j`` as a comma separated list,
+    ``chunk`` ids per call, and the output is scanned line by line
+    while qstat is still writing it.
+
+    Args:
+        idxes (iterable): job ids as strings
+        chunk (int): the number of job ids in one qstat call
+        timeout (float): seconds before a qstat call is given up, its
+            jobs are left out then
+
+    Returns:
+        dict: job id -> folder, only for the jobs qstat reported
+
+    """
+    folders={}
+    idxes=list(dict.fromkeys(idxes))
+    for i in range(0,len(idxes),chunk):
+        comm=['qstat','-j',','.join(idxes[i:i+chunk])]
+        if QUERY_CACHE is not None:
+            # qstat returns 1 if some of the jobs are gone, it is fine
+            try:
+                out=query_output(comm,check=False,timeout=timeout)
+            except subprocess.TimeoutExpired:
+                continue
+            except OSError:
+                return folders
+            _read_job_folders(out.decode("utf-8","replace").splitlines(),
+                              folders)
+            continue
+        t0=time.perf_counter()
+        try:
+            proc=subprocess.Popen(comm,stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL)
+        except OSError:
+            return folders
+        try:
+            with deadline(proc,comm,timeout):
+                _read_job_folders((line.decode("utf-8","replace") 
+                                   for line in proc.stdout),folders)
+                proc.wait()
+        except subprocess.TimeoutExpired:
+            proc.wait()
+        finally:
+            proc.stdout.close()
+            METRICS.add_command(comm,time.perf_counter()-t0)
+    return folders
+
+# the working folders in the output of qstat -j, put in folders
+def _read_job_folders(lines,folders):
+    idx=None
+    for line in lines:
+        if line.startswith('job_number:'):
+            idx=line.split()[1]
+        elif line.startswith('sge_o_workdir:') and idx:
+            ss=line.split()
+            if len(ss)>1:
+                folders[idx]=ss[1]
+
+####################################
+def iter_job_folders(path,stop_at_job=True,ignore=(),max_depth=None,
+                     prefix='',probes=None):
+    """ Walk below path and yield the job folders in sorted order
+
+    A job folder is a folder with job.begin.  Every folder is listed
+    once with os.scandir, the folders are yielded while walking.
+
+    Args:
+        path (string): the root of the walk
+        stop_at_job (bool): do not look into the subfolders of a job
+            folder
+        ignore (iterable): glob patterns of folders to skip, matched
+            against the folder name and the path relative to the root
+        max_depth (int): how deep below path to look, None for no limit
+        prefix (string): the path of path relative to the root the
+            ignore patterns are meant for, when walking a part of a tree
+        probes (dict): if given, the FolderProbe of each job folder is
+            put there from its listing in the walk, before it is yielded
+
+    Yields:
+        string: the job folders
+
+    """
+    path=os.path.abspath(path)
+    ignore=tuple(ignore)
+
+    def skip(rel,name):
+        for pattern in ignore:
+            if fnmatch.fnmatch(name,pattern) or fnmatch.fnmatch(rel,pattern):
+                return True
+        return False
+
+    def walk(folder,rel,depth):
+        METRICS.visit_folder()
+        try:
+            with os.scandir(folder) as it:
+                entries=list(it)
+        except OSError:
+            return
+        subdirs=[]
+        is_job=False
+        for entry in entries:
+            try:
+                if entry.name=='job.begin' and entry.is_file():
+                    is_job=True
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+            except OSError:
+                pass
+        if is_job:
+            if probes is not None:
+                probes[folder]=probe_entries(folder,entries)
+            yield folder
+            if stop_at_job:
+                return
+        if max_depth is not None and depth>=max_depth:
+            return
+        subdirs.sort()
+        for name in subdirs:
+            sub_rel=os.path.join(rel,name) if rel else name
+            if not skip(sub_rel,name):
+                yield from walk(os.path.join(folder,name),sub_rel,depth+1)
+
+    yield from walk(path,prefix,0)
+
+
+##################################################
+# job manifest at the scan root
+###################################################
+# the job folders below the root, one path relative to the root a line;
+# a folder is added when a job is submitted from it, a check lists the
+# manifest instead of walking the tree when there is one
+manifest_file='.jobcheck_manifest'
+
+def _read_manifest(fname):
+    with open(fname) as fp:
+        lines=[line.rstrip('\n') for line in fp]
+    METRICS.read_file(sum(len(line)+1 for line in lines))
+    return frozenset(line for line in lines if line)
+
+def read_manifest(path):
+    """ The folders in the manifest of a root
+
+    Args:
+        path (string): the root
+
+    Returns:
+        frozenset: the folders relative to the root, None if the root
+        has no manifest
+
+    """
+    return cached_parse('manifest',os.path.join(path,manifest_file),
+                        _read_manifest)
+
+def manifest_folders(path,stop_at_job=True,ignore=(),max_depth=None):
+    """ The job folders of the manifest, like iter_job_folders would
+    find them
+
+    The folders are not checked for job.begin here.
+
+    Args:
+        path (string): the root
+        stop_at_job, ignore, max_depth: as in iter_job_folders
+
+    Returns:
+        list: the folders in walk order, None if there is no manifest
+
+    """
+    path=os.path.abspath(path)
+    listed=read_manifest(path)
+    if listed is None:
+        return None
+    ignore=tuple(ignore)
+    folders=[]
+    for rel in listed:
+        parts=[] if rel=='.' else rel.split(os.sep)
+        if max_depth is not None and len(parts)>max_depth:
+            continue
+        prefixes=[os.sep.join(parts[:n]) for n in range(1,len(parts))]
+        if any(fnmatch.fnmatch(parts[n],pattern) or 
+               fnmatch.fnmatch(os.sep.join(parts[:n+1]),pattern)
+               for n in range(len(parts)) for pattern in ignore):
+            continue
+        # a job folder inside a job folder is not looked at
+        if stop_at_job and parts and ('.' in listed or 
+                                      any(p in listed for p in prefixes)):
+            continue
+        folders.append(os.path.join(path,*parts))
+    folders.sort(key=walk_order)
+    return folders
+
+def write_manifest(path,folders):
+    """ Write the manifest of a root, replacing the old one
+
+    Args:
+        path (string): the root
+        folders (iterable): the job folders
+
+    Returns:
+        int: the number of folders
+
+    """
+    path=os.path.abspath(path)
+    rels=sorted(set(os.path.relpath(os.path.abspath(folder),path)
+                    for folder in folders))
+    with atomic_open(os.path.join(path,manifest_file)) as fp:
+        fp.writelines(rel+'\n' for rel in rels)
+    return len(rels)
+
+def find_job_folders(path,stop_at_job=True,ignore=(),max_depth=None,
+                     probes=None):
+    """ The job folders below path, from the manifest if the root has
+    one, by walking the tree otherwise
+
+    Args:
+        path (string): the root
+        stop_at_job, ignore, max_depth, probes: as in iter_job_folders,
+            the folders of a manifest get no probe
+
+    Returns:
+        list: the folders in walk order; the folders of a manifest are
+            not checked for a job.begin, their probe_folder does it
+
+    """
+    folders=manifest_folders(path,stop_at_job,ignore,max_depth)
+    if folders is None:
+        return list(iter_job_folders(path,stop_at_job,ignore,max_depth,
+                                     probes=probes))
+    return folders
+
+def rebuild_manifest(path,stop_at_job=True,ignore=(),max_depth=None):
+    """ Walk the tree once and write the manifest of what is found """
+    return write_manifest(path,iter_job_folders(path,stop_at_job,ignore,
+                                                max_depth))
+
+# the root whose manifest covers a folder, the nearest parent with a
+# manifest, None if there is none
+def find_manifest(folder):
+    folder=os.path.abspath(folder)
+    while True:
+        if os.path.isfile(os.path.join(folder,manifest_file)):
+            return folder
+        parent=os.path.dirname(folder)
+        if parent==folder:
+            return None
+        folder=parent
+
+def register_folders(folders,root=None):
+    """ Add job folders to the manifest if they are not there yet
+
+    Args:
+        folders (iterable): the job folders
+        root (string): the root, the nearest parent with a manifest of
+            each folder if not given
+
+    Returns:
+        int: the number of folders added
+
+    """
+    new=collections.OrderedDict()
+    for folder in folders:
+        folder=os.path.abspath(folder)
+        top=os.path.abspath(root) if root else find_manifest(folder)
+        if top is None:
+            continue
+        rel=os.path.relpath(folder,top)
+        if rel.startswith(os.pardir):
+            continue
+        listed=read_manifest(top) or ()
+        if rel not in listed:
+            new.setdefault(top,[]).append(rel)
+    for top,rels in new.items():
+        # appended under a lock, several checks or submissions may add
+        # folders at the same time
+        fname=os.path.join(top,manifest_file)
+        with open(fname,'a') as fp:
+            fcntl.flock(fp,fcntl.LOCK_EX)
+            try:
+                size=fp.seek(0,os.SEEK_END)
+                fp.writelines(rel+'\n' for rel in rels)
+                fp.flush()
+                # keep the parsed manifest if nobody else wrote to it,
+                # so many submissions do not read it again each time
+                old=_parse_cache.pop(('manifest',fname),None)
+                if old is not None and old[0]==size:
+                    st=os.fstat(fp.fileno())
+                    _parse_cache[('manifest',fname)]=(
+                        st.st_size,st.st_mtime_ns,old[2]|frozenset(rels))
+            finally:
+                fcntl.flock(fp,fcntl.LOCK_UN)
+    return sum(len(rels) for rels in new.values())
+
+##################################################
+# help function
+##################################################
+def character_frame(word):
+    return '#'*50+'\n# '+word+'\n'+'#'*50
+
+# run func with everything it prints going to the file fname, the
+# output is streamed into a temporary file which replaces fname at the
+# end, so a reader never sees half a report; if func fails the report
+# written so far is kept, like before
+def run_to_file(fname,func,*args,**kwargs):
+    oldstdout = sys.stdout
+    tmp='{}.tmp{}'.format(fname,os.getpid())
+    try:
+        with open(tmp,'w') as fp:
+            sys.stdout = fp
+            try:
+                return func(*args,**kwargs)
+            finally:
+                sys.stdout.flush()
+                sys.stdout=oldstdout
+    finally:
+        os.replace(tmp,fname)
+
+# the file the next check is profiled into, set by --profile and
+# kill -USR1, None to run the checks as they are
+PROFILE_FILE=None
+
+def profiled(func,*args,**kwargs):
+    """ Run a check, with cProfile if PROFILE_FILE is set
+
+    PROFILE_FILE is cleared, so only one check is profiled.
+    """
+    global PROFILE_FILE
+    fname,PROFILE_FILE=PROFILE_FILE,None
+    if fname is None:
+        return func(*args,**kwargs)
+    profile=cProfile.Profile()
+    profile.enable()
+    try:
+        return func(*args,**kwargs)
+    finally:
+        profile.disable()
+        profile.dump_stats(fname)
+
+# the JSON status written next to a text report
+def status_file(report):
+    return os.path.splitext(report)[0]+'.json'
+
+def write_status(fname,qjobs,fjobs):
+    """ Write the status of the queue and the job folders as JSON
+
+    Args:
+        fname (string): the file, replaced at once
+        qjobs (Qjob_list): the queue at the check
+        fjobs (Fjob_list): the job folders
+
+    """
+    doc={'time':fjobs.ctime.isoformat() if fjobs.ctime else None,
+         'summary':fjobs.dict_jobs(),
+         'queue':{'servers':qjobs.servers,'running':qjobs.n_rjobs(),
+                  'submitted':qjobs.n_jobs(),
+                  'jobs':[qjob.as_dict() for qjob in qjobs.qjobs]},
+         'folders':[fjob.as_dict() for fjob in fjobs.fjobs]}
+    with atomic_open(fname) as fp:
+        json.dump(doc,fp,indent=1)
+
+@contextlib.contextmanager
+def tick_lock(path,fname='.jobcheck.lock'):
+    """ Take the check lock of a tree, without waiting for it
+
+    Only one check at a time runs in a tree, whether it is started by
+    the scheduler, the watch or daemon loop or by hand.
+
+    Args:
+        path (string): the root of the job folders
+        fname (string): the lock file in path
+
+    Yields:
+        bool: True if the lock is held, False if another check has it
+
+    """
+    with open(os.path.join(path,fname),'a') as fp:
+        try:
+            fcntl.flock(fp,fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN,errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp,fcntl.LOCK_UN)
+
+
+##################################################
+# shared cache of the queue queries
+###################################################
+class QueryCache:
+    """ The outputs of qstat shared by the jobchecks of a user
+
+    An output is kept in a file of the cache folder and served to every
+    jobcheck for ttl seconds.  When it is older, the first jobcheck
+    that takes the lock of the query runs it again while the others
+    wait for the lock and read the new output; a jobcheck that waits
+    longer than the timeout of the query runs it itself.  qsub and qdel
+    invalidate every output: they move the generation of the cache on,
+    and an output of an older generation is not served.
+
+    The outputs decide what is killed and submitted, so the folder must
+    be a real folder of the user with mode 0700, and only files of the
+    user are read from it.
+
+    Args:
+        folder (string): the cache folder, /dev/shm/jobcheck-<uid> by
+            default (in the temporary folder without /dev/shm)
+        ttl (float): seconds an output is served
+
+    Raises:
+        OSError: the folder is not private to the user
+
+    """
+    def __init__(self,folder=None,ttl=30):
+        if folder is None:
+            base='/dev/shm' if os.path.isdir('/dev/shm') \
+                else tempfile.gettempdir()
+            folder=os.path.join(base,'jobcheck-{}'.format(os.getuid()))
+        try:
+            os.mkdir(folder,0o700)
+        except FileExistsError:
+            pass
+        st=os.lstat(folder)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid!=os.getuid() or \
+           stat.S_IMODE(st.st_mode)!=0o700:
+            raise PermissionError(errno.EPERM,'not a folder of mode 0700 '
+                                  'owned by the user',folder)
+        self.folder=folder
+        self.ttl=ttl
+        self.generation_file=os.path.join(folder,'generation')
+
+    def _fname(self,comm):
+        key=hashlib.sha1('\0'.join(comm).encode()).hexdigest()
+        return os.path.join(self.folder,key)
+
+    # open a file of the cache, never through a symbolic link, and only
+    # if it is the user's
+    def _open(self,fname,flags=os.O_RDWR|os.O_CREAT):
+        fd=os.open(fname,flags|os.O_NOFOLLOW,0o600)
+        try:
+            if os.fstat(fd).st_uid!=os.getuid():
+                raise PermissionError(errno.EPERM,'not owned by the user',
+                                      fname)
+            return os.fdopen(fd,'rb' if flags==os.O_RDONLY else 'r+b')
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def generation(self):
+        try:
+            with self._open(self.generation_file,os.O_RDONLY) as fp:
+                return int(fp.read() or 0)
+        except (OSError,ValueError):
+            return 0
+
+    def invalidate(self):
+        with self._open(self.generation_file) as fp:
+            fcntl.flock(fp,fcntl.LOCK_EX)
+            try:
+                n=int(fp.read() or 0)
+            except ValueError:
+                n=0
+            # one write of the same width, a reader sees the old value
+            # or the new one
+            os.pwrite(fp.fileno(),b'%020d'%(n+1),0)
+
+    # the output if it is fresh, None otherwise (or if it is damaged)
+    def _read(self,fname):
+        try:
+            with self._open(fname,os.O_RDONLY) as fp:
+                head=fp.readline().split()
+                data=fp.read()
+        except OSError:
+            return None
+        try:
+            if len(head)!=2 or int(head[0])!=self.generation() or \
+               time.time()-float(head[1])>=self.ttl:
+                return None
+        except ValueError:
+            return None
+        return data
+
+    # written to a new temporary file that replaces the output
+    def _write(self,fname,generation,t,data):
+        fd,tmp=tempfile.mkstemp(dir=self.folder)
+        try:
+            with os.fdopen(fd,'wb') as fp:
+                fp.write('{} {!r}\n'.format(generation,t).encode())
+                fp.write(data)
+            os.replace(tmp,fname)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @staticmethod
+    def _try_lock(lock):
+        try:
+            fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def get(self,comm,run,fresh=False,timeout=None):
+        """ The output of a query
+
+        Args:
+            comm (list): the command, the key of the output
+            run (function): run() runs the command and returns its output
+            fresh (bool): run it anyway, the output is still kept
+            timeout (float): seconds to wait for the lock of the query
+                before it is run anyway, None for no limit
+
+        Returns:
+            bytes: the output
+
+        """
+        fname=self._fname(comm)
+        data=None if fresh else self._read(fname)
+        if data is not None:
+            return data
+        end=None if timeout is None else time.time()+timeout
+        with self._open(fname+'.lock') as lock:
+            while not fresh:
+                if self._try_lock(lock):
+                    # it may have been run while we waited
+                    data=self._read(fname)
+                    if data is not None:
+                        return data
+                    break
+                if end is not None and time.time()>=end:
+                    break
+                time.sleep(0.05)
+            generation,t=self.generation(),time.time()
+            data=run()
+            self._write(fname,generation,t,data)
+            return data
+
+    async def aget(self,comm,run,fresh=False,timeout=None):
+        """ get with a coroutine function run, the lock is waited for
+        without blocking the loop """
+        fname=self._fname(comm)
+        data=None if fresh else self._read(fname)
+        if data is not None:
+            return data
+        end=None if timeout is None else time.time()+timeout
+        with self._open(fname+'.lock') as lock:
+            while not fresh:
+                if self._try_lock(lock):
+                    data=self._read(fname)
+                    if data is not None:
+                        return data
+                    break
+                if end is not None and time.time()>=end:
+                    break
+                await asyncio.sleep(0.05)
+            generation,t=self.generation(),time.time()
+            data=await run()
+            self._write(fname,generation,t,data)
+            return data
+
+# the QueryCache of the queue queries, None to always ask the queue
+QUERY_CACHE=None
+
+def invalidate_queries():
+    if QUERY_CACHE is not None:
+        QUERY_CACHE.invalidate()
+
+def query_output(comm,check=True,fresh=False,timeout=None):
+    """ The output of a qstat query, from QUERY_CACHE if it is set
+
+    Args:
+        comm (list): the command
+        check (bool): raise CalledProcessError on a non zero exit code,
+            the output is not kept then
+        fresh (bool): do not take a kept output
+        timeout (float): seconds before the command is killed, None
+            for no limit
+
+    Returns:
+        bytes: the output
+
+    Raises:
+        subprocess.TimeoutExpired: the command took too long
+
+    """
+    def run():
+        with METRICS.command(comm):
+            proc=subprocess.run(comm,stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,timeout=timeout)
+        if check and proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode,comm,
+                                                proc.stdout)
+        return proc.stdout
+    if QUERY_CACHE is None:
+        return run()
+    return QUERY_CACHE.get(comm,run,fresh,timeout)
+
+async def async_query_output(comm,timeout=60,check=True,fresh=False):
+    """ query_output with run_command """
+    def run():
+        return run_command(comm,timeout,check=check)
+    if QUERY_CACHE is None:
+        return await run()
+    return await QUERY_CACHE.aget(comm,run,fresh,timeout)
+
+
+##################################################
+# queue snapshot from qstat -xml
+def submitted_arrays(path):
+    """ The job ids of the array jobs SubmitQueue sent from a tree
+
+    Args:
+        path (string): the root of the job folders
+
+    Returns:
+        frozenset: the ids with a task list <job id>.list
+
+    """
+    try:
+        with os.scandir(array_dir(path)) as it:
+            return frozenset(entry.name[:-5] for entry in it
+                             if entry.name.endswith('.list') and
+                             entry.name[:-5].isdigit())
+    except OSError:
+        return frozenset()
+
+def prune_arrays(path,snapshot,keep=3600):
+    """ Remove the task lists and scripts of the array jobs that left
+    the queue
+
+    A task list, <job id>.list, is a link of the list written for the
+    qsub; both go with the script of the job.  The files younger than
+    keep seconds are left, their job may have been sent after the
+    snapshot was taken, as are the ones of another user.
+
+    Args:
+        path (string): the root of the job folders
+        snapshot (Qsnapshot): our jobs in the queue
+        keep (float): seconds
+
+    Returns:
+        frozenset: the ids of the array jobs still kept, as
+            submitted_arrays
+
+    """
+    folder=array_dir(path)
+    alive=set(job.idx for job in snapshot.jobs)
+    old=snapshot.time.timestamp()-keep
+    files={}  # inode -> (mtime,[names of the lists])
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.name.endswith('.list'):
+                    continue
+                try:
+                    st=entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if st.st_uid!=os.getuid():
+                    continue
+                files.setdefault(st.st_ino,(st.st_mtime,[]))[1].append(
+                    entry.name)
+    except OSError:
+        return frozenset()
+    kept=set()
+    for mtime,names in files.values():
+        ids=[name[:-5] for name in names if name[:-5].isdigit()]
+        if mtime>=old or any(idx in alive for idx in ids):
+            kept.update(ids)
+            continue
+        for name in names:
+            fnames=[name]
+            if not name[:-5].isdigit():
+                fnames.append(name[:-5]+'.sh')
+            for fname in fnames:
+                try:
+                    os.remove(os.path.join(folder,fname))
+                except OSError:
+                    pass
+    return frozenset(kept)
+
+###################################################
+# one job (or array task) in the queue
+Qrecord=collections.namedtuple('Qrecord',
+                               'idx status btime server slots name task')
+
+def expand_tasks(tasks):
+    """ The task ids of the tasks field of qstat
+
+    Args:
+        tasks (string): like 7, 1-50:1 or 1-3:1,7; None for a job that
+            is not an array job
+
+    Returns:
+        list: the task ids as strings, [None] for a plain job
+
+    """
+    if not tasks:
+        return [None]
+    ids=[]
+    for part in tasks.split(','):
+        m=re.match(r'(\d+)(?:-(\d+)(?::(\d+))?)?$',part.strip())
+        if m:
+            first=int(m.group(1))
+            last=int(m.group(2) or first)
+            step=int(m.group(3) or 1)
+            ids.extend(str(task) for task in range(first,last+1,step))
+    return ids or [None]
+
+# the id of a task of an array job, job.task, or the job id
+def task_id(idx,task):
+    return idx if task is None else idx+'.'+task
+
+# the job id of a task id
+def job_number(idx):
+    return idx.split('.',1)[0]
+
+def qstat_time(text):
+    """ Convert a time from qstat -xml into a datetime
+
+    Args:
+        text (string): an ISO time like 2018-10-18T16:32:52, or
+            seconds (milliseconds) since the epoch on some versions
+
+    Returns:
+        datetime: the time, None if it can not be understood
+
+    """
+    if not text:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    try:
+        x=float(text)
+    except ValueError:
+        return None
+    if x>1e11:
+        x=x/1000
+    return datetime.datetime.fromtimestamp(x)
+
+def parse_qstat_xml(stream):
+    """ Parse qstat -xml output incrementally
+
+    Args:
+        stream: a binary file object with the qstat -xml output
+
+    Returns:
+        list: Qrecord of every job in the output
+
+    """
+    records=[]
+    for event,elem in ET.iterparse(stream,events=('end',)):
+        if elem.tag!='job_list':
+            continue
+        idx=elem.findtext('JB_job_number','').strip()
+        status=elem.findtext('state','').strip()
+        btime=qstat_time(elem.findtext('JAT_start_time') or 
+                         elem.findtext('JB_submission_time'))
+        queue=elem.findtext('queue_name') or ''
+        matchObj = re.match( r'(.*)@', queue)
+        if matchObj:
+            server=matchObj.group(1)
+        else:
+            # a waiting job is not in a queue yet, take the one asked for
+            server=(elem.findtext('hard_req_queue') or '').strip() or "all.q"
+        slots=elem.findtext('slots','').strip()
+        name=elem.findtext('JB_name','').strip()
+        task=(elem.findtext('tasks') or '').strip() or None
+        records.append(Qrecord(idx,status,btime,server,slots,name,task))
+        elem.clear()
+    return records
+
+class Qsnapshot(collections.namedtuple('Qsnapshot','jobs time')):
+    """ An immutable picture of my queue, shared by a whole tick
+
+    jobs is a tuple of Qrecord, time is when the picture was taken.
+    """
+    __slots__=()
+
+    def updated(self,killed=(),submitted=(),alive=None):
+        """ A new snapshot after this tick's qdel and qsub
+
+        Only the submitted jobs are asked from the queue again, the
+        killed ones are simply dropped.
+
+        Args:
+            killed (iterable): ids of the killed jobs
+            submitted (iterable): (idx,server) of the new jobs
+            alive (dict): the result of bulk_job_folders for the new
+                jobs, if it is asked already
+
+        Returns:
+            Qsnapshot: the updated snapshot
+
+        """
+        killed=set(killed)
+        jobs=[job for job in self.jobs 
+              if task_id(job.idx,job.task) not in killed]
+        submitted=list(submitted)
+        if submitted:
+            now=datetime.datetime.now()
+            if alive is None:
+                alive=bulk_job_folders(job_number(idx) 
+                                       for idx,server in submitted)
+            for idx,server in submitted:
+                number,dot,task=idx.partition('.')
+                if number in alive:
+                    jobs.append(Qrecord(number,'qw',now,server,'1','',
+                                        task or None))
+        return Qsnapshot(tuple(jobs),datetime.datetime.now())
+
+    def tasks(self):
+        """ Yield (id, Qrecord) of every job, and of every task of the
+        array jobs with job.task as the id """
+        for job in self.jobs:
+            for task in expand_tasks(job.task):
+                yield task_id(job.idx,task),job
+
+    # the ids of the jobs and tasks in the snapshot, an array job is
+    # there as long as one of its tasks is
+    def ids(self):
+        ids=set(idx for idx,job in self.tasks())
+        ids.update(job.idx for job in self.jobs)
+        return ids
+
+    def own_arrays(self,arrays):
+        """ A snapshot where only our array jobs are split into tasks
+
+        The waiting tasks of an array job are one record with a range
+        of tasks.  Only the tasks of the array jobs sent by SubmitQueue
+        have folders of their own; the range of any other array job is
+        kept as one job, in the folder it was submitted from.
+
+        Args:
+            arrays (set): the ids of our array jobs, see submitted_arrays
+
+        Returns:
+            Qsnapshot: the snapshot with the other ranges as plain jobs
+
+        """
+        jobs=tuple(job._replace(task=None)
+                   if job.task and not job.task.isdigit() and
+                   job.idx not in arrays else job
+                   for job in self.jobs)
+        return self._replace(jobs=jobs)
+
+def take_snapshot(user=None,fresh=False,timeout=None):
+    """ Ask the queue once with qstat -xml -r
+
+    Args:
+        user (string): the owner of the jobs, the current user by default
+        fresh (bool): ask the queue even if QUERY_CACHE has an answer
+        timeout (float): seconds before qstat is given up, None for no
+            limit
+
+    Raises:
+        subprocess.TimeoutExpired: qstat took too long
+
+    Returns:
+        Qsnapshot: the jobs of the user
+
+    """
+    if user is None:
+        user=getpass.getuser()
+    comm=['qstat','-xml','-r','-u',user]
+    if QUERY_CACHE is not None:
+        records=parse_qstat_xml(io.BytesIO(query_output(comm,fresh=fresh,
+                                                        timeout=timeout)))
+        return Qsnapshot(tuple(records),datetime.datetime.now())
+    # the output is parsed while qstat is still writing it
+    t0=time.perf_counter()
+    proc=subprocess.Popen(comm,stdout=subprocess.PIPE)
+    with deadline(proc,comm,timeout):
+        try:
+            records=parse_qstat_xml(proc.stdout)
+        finally:
+            proc.stdout.close()
+            ret=proc.wait()
+            METRICS.add_command(comm,time.perf_counter()-t0)
+    if ret:
+        raise subprocess.CalledProcessError(ret,comm)
+    return Qsnapshot(tuple(records),datetime.datetime.now())
+   
+
+##################################################
+# queue placement
+###################################################
+# the load of a cluster queue from qstat -g c
+Qload=collections.namedtuple('Qload','used reserved avail total')
+
+def parse_qstat_gc(text):
+    """ Parse the cluster queue summary of qstat -g c
+
+    Args:
+        text (string): the output of qstat -g c
+
+    Returns:
+        dict: queue -> Qload
+
+    """
+    load={}
+    columns=None
+    for line in text.splitlines():
+        ss=line.split()
+        if not ss or line.startswith('-'):
+            continue
+        if ss[0]=='CLUSTER':
+            columns=ss[1:]
+            continue
+        if columns is None or len(ss)<len(columns):
+            continue
+        row=dict(zip(columns,ss))
+        try:
+            load[ss[0]]=Qload(int(row.get('USED',0)),int(row.get('RES',0)),
+                              int(row.get('AVAIL',0)),int(row.get('TOTAL',0)))
+        except ValueError:
+            pass
+    return load
+
+def take_queue_load(timeout=None):
+    out=query_output(['qstat','-g','c'],timeout=timeout)
+    return parse_qstat_gc(out.decode("utf-8","replace"))
+
+# the placement of a check without asyncio, as async_placement; the
+# waits are unknown without a history, the load {} if qstat -g c failed
+def take_placement(history=None,snapshot=None,timeout=60):
+    placement=Placement(waits=history.waits() if history is not None
+                        else None)
+    if snapshot is not None:
+        placement.observe(snapshot)
+    try:
+        placement.load=take_queue_load(timeout)
+    except (OSError,subprocess.SubprocessError):
+        placement.load={}
+    return placement
+
+class Placement:
+    """ Send each new job to the queue where it should start first
+
+    A queue with free slots (qstat -g c) starts a job at once,
+    counting the jobs already sent there in this check.  A full queue
+    is expected to start it after the usual wait of our jobs there,
+    longer the more jobs we send beyond its free slots.  The waits come
+    from the job History.
+
+    Args:
+        load (dict): queue -> Qload, empty if unknown
+        waits (dict): queue -> the recent waits of our jobs, seconds
+        default_wait (float): seconds, the wait of a queue nothing is
+            known about
+
+    """
+    def __init__(self,load=None,waits=None,default_wait=600):
+        self.load=load or {}
+        self.waits=waits or {}
+        self.default_wait=default_wait
+        self.ages={}      # queue -> waiting time of our waiting jobs
+        self.placed=collections.Counter()  # jobs sent in this check
+
+    def observe(self,snapshot):
+        """ Note how long our waiting jobs have waited
+
+        Args:
+            snapshot (Qsnapshot): our jobs in the queue
+
+        """
+        self.ages={}
+        for job in snapshot.jobs:
+            if job.status=='qw':
+                self.ages.setdefault(job.server,[]).append(
+                    (snapshot.time-job.btime).total_seconds())
+
+    # the usual wait of our jobs in a queue, seconds
+    def typical_wait(self,queue):
+        waits=self.waits.get(queue)
+        if waits:
+            return percentile(waits,50)
+        # our jobs waiting there now have waited at least that long
+        ages=self.ages.get(queue)
+        if ages:
+            return max(ages)
+        return self.default_wait
+
+    # seconds until a new job sent to the queue is expected to start
+    def expected_start(self,queue):
+        load=self.load.get(queue)
+        if load is not None and self.placed[queue]<load.avail:
+            return 0
+        wait=self.typical_wait(queue)
+        if load is None or not load.total:
+            return wait
+        return wait*(1+(self.placed[queue]-load.avail)/load.total)
+
+    def choose(self,queues):
+        """ The queue a new job is sent to, counted as placed there
+
+        Args:
+            queues (list): the queues with room for one more of our jobs,
+                the first one wins a tie
+
+        Returns:
+            string: the queue, None if queues is empty
+
+        """
+        if not queues:
+            return None
+        queue=min(queues,key=self.expected_start)
+        self.placed[queue]+=1
+        return queue
+
+
+##################################################
+# job history
+###################################################
+def percentile(values,q):
+    """ The q-th percentile of values, nearest rank """
+    values=sorted(values)
+    rank=-(-q*len(values)//100)
+    return values[min(len(values),max(1,int(rank)))-1]
+
+class History:
+    """ Submission, start and end times of our jobs
+
+    The times live in a sqlite file at the scan root and are learned
+    from the queue snapshots (submission and start), the qsub and qdel
+    of the checks and job.info (start and end, when a job leaves the
+    queue).  They give the usual waits of each queue, the kill
+    threshold of a waiting job and the end time expected for a running
+    one.  Jobs older than keep_days are dropped.
+
+    Args:
+        path (string): the scan root
+        fname (string): the sqlite file in path
+        keep_days (float): how long a job is kept
+
+    """
+    # a job: [folder, queue, submit, start, end, killed], times in
+    # seconds since the epoch
+    columns=('folder','queue','submit','start','end','killed')
+
+    def __init__(self,path,fname='.jobcheck_history.db',keep_days=30):
+        self.fname=os.path.join(path,fname)
+        self.db=sqlite3.connect(self.fname)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'idx TEXT PRIMARY KEY, folder TEXT, queue TEXT, '
+                        'submit REAL, start REAL, end REAL, killed INTEGER)')
+        with self.db:
+            self.db.execute('DELETE FROM jobs WHERE '
+                            'COALESCE(end,start,submit)<?',
+                            (time.time()-keep_days*86400,))
+        self.jobs={}
+        self.by_folder={}
+        for row in self.db.execute('SELECT idx,folder,queue,submit,start,'
+                                   'end,killed FROM jobs'):
+            self.jobs[row[0]]=list(row[1:])
+            if row[1]:
+                self.by_folder.setdefault(row[1],[]).append(row[0])
+        self.changed=set()
+        self._runtime=None
+        self._waits=None
+
+    def _job(self,idx):
+        job=self.jobs.get(idx)
+        if job is None:
+            job=self.jobs[idx]=[None,None,None,None,None,0]
+        self.changed.add(idx)
+        return job
+
+    def _set_folder(self,idx,job,folder):
+        if folder and job[0]!=folder:
+            job[0]=folder
+            self.by_folder.setdefault(folder,[]).append(idx)
+
+    def observe(self,snapshot):
+        """ Learn from a queue snapshot
+
+        A job seen waiting gives its submission time, a job seen
+        running its start time; a running job gone from the queue has
+        ended, its times are read from job.info if its folder is known.
+
+        Args:
+            snapshot (Qsnapshot): our jobs in the queue
+
+        """
+        seen=set()
+        for idx,record in snapshot.tasks():
+            seen.add(idx)
+            t=record.btime.timestamp()
+            if record.status=='qw':
+                job=self.jobs.get(idx)
+                if job is None or job[2] is None or job[1]!=record.server:
+                    job=self._job(idx)
+                    job[1]=record.server
+                    job[2]=job[2] or t
+            elif 'r' in record.status:
+                job=self.jobs.get(idx)
+                if job is None or job[3] is None:
+                    job=self._job(idx)
+                    job[1]=record.server
+                    job[3]=t
+        now=snapshot.time.timestamp()
+        for idx,job in self.jobs.items():
+            if job[3] is None or job[4] is not None or idx in seen:
+                continue
+            job[4]=now
+            self.changed.add(idx)
+            if job[0]:
+                info=read_job_info(job_number(idx),job[0])
+                if len(info)>2:
+                    job[3]=info[1].timestamp()
+                    job[4]=info[2].timestamp()
+        self._runtime=None
+        self._waits=None
+
+    # the folders of the jobs, once they are known
+    def set_folders(self,qjobs):
+        for qjob in qjobs.qjobs:
+            job=self.jobs.get(qjob.idx)
+            if job is not None and qjob.folder and job[0]!=qjob.folder:
+                self._set_folder(qjob.idx,self._job(qjob.idx),qjob.folder)
+
+    def record_submit(self,idx,folder,queue,when=None):
+        job=self._job(idx)
+        self._set_folder(idx,job,folder)
+        job[1]=queue
+        job[2]=(when or datetime.datetime.now()).timestamp()
+
+    def record_kill(self,idx,folder=None,when=None):
+        job=self._job(idx)
+        self._set_folder(idx,job,folder)
+        job[4]=(when or datetime.datetime.now()).timestamp()
+        job[5]=1
+
+    # queue -> the waits of the last n jobs started there, kept until
+    # the next observe
+    def waits(self,n=200):
+        if self._waits is None:
+            started=collections.defaultdict(list)
+            for job in self.jobs.values():
+                if job[2] is not None and job[3] is not None:
+                    started[job[1]].append((job[3],max(0,job[3]-job[2])))
+            self._waits={queue:[w for t,w in sorted(ws)[-n:]]
+                         for queue,ws in started.items()}
+        return self._waits
+
+    def kills(self,folder):
+        return sum(self.jobs[idx][5] for idx in self.by_folder.get(folder,()))
+
+    def kill_threshold(self,queue,folder,min_wait=3600,q=90):
+        """ Seconds a job may wait before it is killed and resubmitted
+
+        The q-th percentile of the recent waits on the queue, at least
+        min_wait, doubled for every earlier kill in the folder so the
+        same job is not sent to the back of the queue again and again.
+
+        Args:
+            queue (string): the queue of the job
+            folder (string): the job folder
+            min_wait (float): the threshold without history
+            q (float): the percentile of the waits
+
+        Returns:
+            float: seconds
+
+        """
+        waits=self.waits()
+        threshold=min_wait
+        if len(waits.get(queue,()))>=5:
+            threshold=max(min_wait,percentile(waits[queue],q))
+        return threshold*2**min(self.kills(folder),6)
 
-####################################
-def touch(path='./'):
-    basedir = os.path.dirname(path)
-    if not os.path.exists(basedir):
-        os.makedir(basedir)
+    # seconds a job of the folder usually runs, None if unknown
+    def runtime(self,folder):
+        def runtimes(idxes):
+            return [job[4]-job[3] for job in (self.jobs[i] for i in idxes)
+                    if job[3] is not None and job[4] is not None and
+                    not job[5]]
+        own=runtimes(self.by_folder.get(folder,()))
+        if own:
+            return percentile(own,50)
+        if self._runtime is None:
+            all_runs=runtimes(self.jobs)
+            self._runtime=percentile(all_runs,50) if all_runs else False
+        return self._runtime or None
 
-    with open(path, 'a'):
-        os.utime(path, None)
+    # the time a running job started at begin should end, None if
+    # unknown
+    def eta(self,folder,begin):
+        runtime=self.runtime(folder)
+        if runtime is None or begin is None:
+            return None
+        return begin+datetime.timedelta(seconds=runtime)
 
-####################################
-def submit_job(server="all.q",smp=None,path='./'):
-    cwd = os.getcwd()
-    os.chdir(path) 
-    files= glob.glob("dwt*.job")
-    for fname in  files:
-        comm1=["-q", server]
-        res=subprocess.check_output(["qsub"]+comm1+[fname])
-        line=res.decode("utf-8")
-        print(line)
-        with open("job.begin", "a+") as f:
-            f.write(line)
-    os.chdir(cwd)
+    def commit(self):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?)',
+                [(idx,)+tuple(self.jobs[idx]) for idx in self.changed])
+        self.changed=set()
 
-####################################
-def submit_job_based_Q(q=None,path='./'):
-    cwd = os.getcwd()
-    os.chdir(path) 
-    files= glob.glob("dwt*.job")
-    for fname in  files:
-        if q:
-            server=q.available_server()
-            if server:
-                comm1=["-q", server]
-                res=subprocess.check_output(["qsub"]+comm1+[fname])
-                line=res.decode("utf-8")
-                print(line)
-                with open("job.begin", "a+") as f:
-                    f.write(line)
-    os.chdir(cwd)    
+    def close(self):
+        self.db.close()
 
-##################################################
-# help function
-##################################################
-def character_frame(word):
-    return '#'*50+'\n# '+word+'\n'+'#'*50
-   
 
-##################################################
+##########################################
 # define a class to collect information from qstat
 ###################################################
 class Qjob:
+    __slots__=('idx','status','btime','server','slots','folder')
+
     def __init__(self,idx,status,btime,server,slots,folder):
         self.idx = idx
         self.status = status 
@@ -223,81 +2678,137 @@ class Qjob:
             self.slots)
         return  ss     
 
+    def as_dict(self):
+        return {'idx':self.idx,'status':self.status,'server':self.server,
+                'btime':self.btime.isoformat(),'slots':self.slots,
+                'folder':self.folder}
+
     # update the folder of a job based on idx
-    def get_folder(self):
+    def get_folder(self,timeout=None):
         idx=self.idx
         try:
-            res = subprocess.check_output(['qstat','-j',idx])
+            res=query_output(['qstat','-j',job_number(idx)],timeout=timeout)
             match=re.search(r'sge_o_workdir:\s+(\S+)\s+',
                             res.decode("utf-8"))
             if match:
-                self.folder=match.group(1)
+                self.folder=array_task_folder(match.group(1),idx)
             else:
                 self.folder=None
-        except subprocess.CalledProcessError as e:
+        except subprocess.SubprocessError as e:
             self.folder=None
 
 
+# the key of a folder in the folder index
+def folder_key(folder):
+    return os.path.normpath(os.path.abspath(folder))
+
+# whether folder is root or below it
+def in_tree(folder,root):
+    folder,root=folder_key(folder),folder_key(root)
+    return folder==root or folder.startswith(root.rstrip(os.sep)+os.sep)
+
+# the most jobs of ours in each queue, limits given to Qjob_list
+# change these
+default_limits={'UI':0,'INFORMATICS':0,'all.q':10000}
+
 class Qjob_list:
-    def __init__(self):
+    def __init__(self,limits=None):
         self.qjobs=[]
-        self.servers={'UI':0, 'INFORMATICS':0, 'all.q':0}
-        self.servers_max={'UI':0, 'INFORMATICS':0,'all.q':10000}
+        self.servers_max=dict(default_limits)
+        self.servers_max.update(limits or {})
+        self.servers={server:0 for server in self.servers_max}
+        # picks the queue of a new job, the first one with room if None
+        self.placement=None
+        # indexes and counters, kept up to date by append and remove
+        self.by_idx={}
+        self.by_folder={}
+        self._n_rjobs=0
+        # jobs waiting in a SubmitQueue for each server
+        self.reserved={}
 
         
     def __str__(self):
-        ss=""
-        for qjob in self.qjobs:
-            ss=ss+str(qjob)+"\n"
-        return ss.rstrip()
+        return "\n".join(str(qjob) for qjob in self.qjobs).rstrip()
 
     def short_str(self):
-        ss=""
-        for qjob in self.qjobs:
-            ss=ss+qjob.short_str()+"\n"
-        return ss.rstrip()
+        return "\n".join(qjob.short_str() for qjob in self.qjobs).rstrip()
+
+    # the server a job is counted on, None for the local jobs which
+    # take no place in the queues
+    def _server_key(self,qjob):
+        if qjob.server in self.servers:
+            return qjob.server
+        if qjob.server==local_queue:
+            return None
+        return 'all.q'
 
+    def _index_folder(self,qjob):
+        if qjob.folder is not None:
+            key=folder_key(qjob.folder)
+            self.by_folder.setdefault(key,[]).append(qjob)
+
+    def _unindex_folder(self,qjob):
+        if qjob.folder is not None:
+            key=folder_key(qjob.folder)
+            jobs=self.by_folder.get(key,[])
+            if qjob in jobs:
+                jobs.remove(qjob)
+            if not jobs:
+                self.by_folder.pop(key,None)
 
     def append(self,qjob):
         self.qjobs.append(qjob)
+        self.by_idx.setdefault(qjob.idx,qjob)
+        self._index_folder(qjob)
+        if self._server_key(qjob) is not None:
+            self.servers[self._server_key(qjob)]+=1
+        if qjob.status=="r":
+            self._n_rjobs+=1
+
+    # remove the jobs with idx, after they are killed
+    def remove(self,idx):
+        jobs=[job for job in self.qjobs if job.idx==idx]
+        if not jobs:
+            return
+        self.qjobs=[job for job in self.qjobs if job.idx!=idx]
+        del self.by_idx[idx]
+        for job in jobs:
+            self._unindex_folder(job)
+            if self._server_key(job) is not None:
+                self.servers[self._server_key(job)]-=1
+            if job.status=="r":
+                self._n_rjobs-=1
+
+    # set the folder of a job and keep the index right
+    def set_folder(self,qjob,folder):
+        self._unindex_folder(qjob)
+        qjob.folder=folder
+        self._index_folder(qjob)
         
     # check the status givin idx
     def checkstatus(self,idx):
-        for job in self.qjobs:
-            if idx==job.idx:
-                return job.status
-        return "n"
+        job=self.by_idx.get(idx)
+        if job is None:
+            return "n"
+        return job.status
         
     # find a job based on idx    
     def find(self,idx):
-        for job in self.qjobs:
-            if idx==job.idx:
-                return job
-        return None
+        return self.by_idx.get(idx)
         
     # find a job based on the folder
     def find_base_folder(self,folder):
-        jobs_list=[job for job in self.qjobs if \
-                   job.folder is not None and \
-                   os.path.abspath(job.folder)==os.path.abspath(folder) and \
-                   job.status!='dr']
-        return jobs_list
+        jobs=self.by_folder.get(folder_key(folder),[])
+        return [job for job in jobs if job.status!='dr']
 
     # how many UI used    
     def UI_usage(self):
-        n=0
-        for job in self.qjobs:
-            if job.server=="UI":
-                n+=1
-        return n
+        return self.servers['UI']
 
-    # update number of jobs on each server
+    # number of jobs on each server is kept by append and remove,
+    # nothing left to do here
     def update_servers(self):
-        for job in self.qjobs:
-            try:
-                self.servers[job.server]+=1
-            except KeyError:
-                self.servers['all.q']+=1
+        return self.servers
 
     # how many jobs submitted
     def n_jobs(self):
@@ -305,99 +2816,100 @@ class Qjob_list:
     
     # how many jobs running
     def n_rjobs(self):
-        n=0
-        for job in self.qjobs:
-            if job.status=="r":
-                n+=1
-        return n
+        return self._n_rjobs
 
-    # available server for submit
+    # available server for submit, the server is counted when the
+    # new job is appended
     def available_server(self):
-        for server,number in self.servers.items():
-            if number<self.servers_max[server]:
-                self.servers[server]+=1
-                return server
-        return None
+        servers=self._open_servers()
+        if self.placement is not None:
+            return self.placement.choose(servers)
+        return servers[0] if servers else None
 
-    # update itself based on myq results
-    def myq(self):
-        res=subprocess.check_output("myq").decode("utf-8")
-        lines=res.splitlines()
-        if not lines:
-            return 
-        line0=lines[0]
-        del lines[0:2]
-
-        vars=('job-ID','prior','name','user','state', 
-              'submit/start at','queue', 'slots ja-task-ID')
-        bnd=[re.search(var,line0).start(0) for var in vars]
-        bnd.append(0)
-        dict={'idx':0,'status':4,'btime':5,'queue':6,'slots':7}
-
-        for line in lines:
-            bnd[-1]=len(line)
-            n=dict['idx']
-            idx=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['status']
-            status=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['btime']
-            btime_str=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['queue']
-            queue=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['slots']
-            slots=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-
-            btime=datetime.datetime.strptime(btime_str, "%m/%d/%Y %H:%M:%S")
-            matchObj = re.match( r'(.*)@', queue, re.M|re.I)
-            if matchObj:
-                server=matchObj.group(1)
-            else:
-                server="all.q"
-            # get folder
-            qjob=Qjob(idx,status,btime,server,slots,folder=None)
-            qjob.get_folder()
+    def _open_servers(self):
+        return [server for server,number in self.servers.items()
+                if number+self.reserved.get(server,0)<
+                self.servers_max[server]]
+
+    # seconds until a new job would start in the best queue, without
+    # placing it there, None if unknown
+    def expected_wait(self):
+        if self.placement is None:
+            return None
+        servers=self._open_servers()
+        if not servers:
+            return float('inf')
+        return min(self.placement.expected_start(server) 
+                   for server in servers)
+
+    # hold a place on a server for a job not submitted yet
+    def reserve(self,server):
+        self.reserved[server]=self.reserved.get(server,0)+1
+
+    def release(self,server):
+        self.reserved[server]-=1
+
+    # update itself based on a queue snapshot, a new snapshot is
+    # taken if none is given, timeout: seconds before a qstat call is
+    # given up
+    # arrays: the ids of our array jobs (submitted_arrays) when the
+    # snapshot is taken here, the waiting tasks of the others are one job
+    def myq(self,snapshot=None,folders=True,timeout=None,arrays=()):
+        if snapshot is None:
+            snapshot=take_snapshot(timeout=timeout).own_arrays(arrays)
+        # a task of an array job is a job with the id job.task
+        for idx,job in snapshot.tasks():
+            qjob=Qjob(idx,job.status,job.btime,job.server,job.slots,
+                      folder=None)
             self.append(qjob)
+        # get folders
+        if folders:
+            self.get_folders(timeout)
 
-    def myq_without_folder(self):
-        res=subprocess.check_output("myq").decode("utf-8")
-        lines=res.splitlines()
-        if not lines:
-            return 
-        line0=lines[0]
-        del lines[0:2]
-
-        vars=('job-ID','prior','name','user','state', 
-              'submit/start at','queue', 'slots ja-task-ID')
-        bnd=[re.search(var,line0).start(0) for var in vars]
-        bnd.append(0)
-        dict={'idx':0,'status':4,'btime':5,'queue':6,'slots':7}
-
-        for line in lines:
-            bnd[-1]=len(line)
-            n=dict['idx']
-            idx=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['status']
-            status=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['btime']
-            btime_str=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['queue']
-            queue=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-            n=dict['slots']
-            slots=line[bnd[n]:bnd[n+1]].rstrip().lstrip()
-
-            btime=datetime.datetime.strptime(btime_str, "%m/%d/%Y %H:%M:%S")
-            matchObj = re.match( r'(.*)@', queue, re.M|re.I)
-            if matchObj:
-                server=matchObj.group(1)
+    def myq_without_folder(self,snapshot=None):
+        self.myq(snapshot,folders=False)
+
+    # update the folders of all jobs, one qstat -j per job only
+    # for the jobs the bulk query missed
+    def get_folders(self,timeout=None):
+        folders=bulk_job_folders((job_number(job.idx) for job in self.qjobs),
+                                 timeout=timeout)
+        for job in self.qjobs:
+            self._unindex_folder(job)
+            if job_number(job.idx) in folders:
+                job.folder=array_task_folder(folders[job_number(job.idx)],
+                                             job.idx)
             else:
-                server="all.q"
-            
-            qjob=Qjob(idx,status,btime,server,slots,folder=None)
-            self.append(qjob)
+                job.get_folder(timeout)
+            self._index_folder(job)
 
-    def get_folders(self):
-       for job in self.qjobs:
-            job.get_folder()
+    # known: idx -> folder of the jobs found earlier, they are not
+    # asked again since the folder of a job does not change
+    async def aget_folders(self,timeout=60,known=None):
+        # the working folders are asked by job id, the tasks of an array
+        # job are mapped to their folders afterwards
+        known=known or {}
+        workdirs=await async_bulk_job_folders(
+            (job_number(job.idx) for job in self.qjobs 
+             if job.idx not in known),timeout=timeout)
+        missed=set(job_number(job.idx) for job in self.qjobs
+                   if job.idx not in known)-set(workdirs)
+        if missed:
+            # one qstat -j each, but all at the same time
+            more=await asyncio.gather(
+                *(async_bulk_job_folders([idx],timeout=timeout)
+                  for idx in missed),return_exceptions=True)
+            for res in more:
+                if isinstance(res,dict):
+                    workdirs.update(res)
+        for job in self.qjobs:
+            self._unindex_folder(job)
+            if job.idx in known:
+                job.folder=known[job.idx]
+            else:
+                job.folder=array_task_folder(
+                    workdirs.get(job_number(job.idx)),job.idx)
+            self._index_folder(job)
 
 
 ##########################################
@@ -410,106 +2922,162 @@ class Qjob_list:
 # n: not running, check folder, update to d or nd
 # d: done, good
 # nd: not done and not running, resubmit
+class Status(str,enum.Enum):
+    """ Status of a job folder, equal to its short string """
+    DONE='d'
+    NOT_DONE='nd'
+    RUNNING='r'
+    WAITING='qw'
+    ERROR='Eqw'
+    PLURAL='p'
+    UNKNOWN='un'
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self,spec):
+        return format(self.value,spec)
+
+def time_str(t):
+    return datetime.datetime.strftime(t,"%m/%d/%Y %H:%M:%S")
+
 class Fjob: 
-    def __init__(self,folder,status,message):
+    """ A job folder and what was found there
+
+    The message is only written when it is asked for, from the job
+    found in the queue (qjobs), the times and the check time (ctime).
+    """
+    __slots__=('folder','status','idx','qjobs','btime','ctime','kill',
+               'kill_result','eta','probe','_message')
+
+    def __init__(self,folder,status,message=None,idx=None,qjobs=(),
+                 btime=None,ctime=None,kill=False):
         self.folder = folder
-        self.status = status 
-        self.message = message
+        self.status = Status(status) 
+        self.idx = idx
+        self.qjobs = tuple(qjobs)
+        self.btime = btime    # job beginning time
+        self.ctime = ctime    # check time
+        self.kill = kill      # the job should be killed and resubmitted
+        # outcome of the qdel, if the job was killed
+        self.kill_result = None
+        self.eta = None       # expected end of a running job
+        # the FolderProbe the folder was classified by, kept until the
+        # job to kill is resubmitted
+        self.probe = None
+        self._message = message
     
     def __str__(self):
         ss="------------------------------------------\n{}\n{}".format(
             self.folder,self.message)
         return  ss   
 
-    # class method, to create all kinds of Fjob
-    def create_done_job(path):
-        status='d'
-        idx=job_done_id(path)
-        info=read_job_info(idx,path)
-        if len(info)>2:
-            btime=info[1]
-            etime=info[2]
-            dtime=etime-btime
-            dtime_str=nice_sec2str(dtime.total_seconds())
-            ss1="Done"
-            ss2="Simulation time "+dtime_str
+    @property
+    def message(self):
+        if self._message is None:
+            message=self._render()
         else:
-            ss1="Done"
-            ss2="Simulation time unknown"
-        message=ss1+"\n"+ss2
-        return Fjob(path,status,message)
-
-    def create_not_done_job(path):
-        status='nd'
-        ctime=datetime.datetime.now()
-        ctime_str=datetime.datetime.strftime(ctime,
-                                             "%m/%d/%Y %H:%M:%S")
-        ss1='Not running'
-        ss2="Checked at "+ctime_str
-        message=ss1+"\n"+ss2
-        return Fjob(path,status,message)
-
-    def create_run_job(qjob,path):
-        status='r'
-        idx=qjob.idx
-        info=read_job_info(idx,path)
-        stime=qjob.btime  # job submission time
-        btime=info[1]     # job beginning time
-        ctime=datetime.datetime.now() # current time
-        dtime=ctime-btime  # job running time
-
-        ctime_str=datetime.datetime.strftime(ctime,
-                                    "%m/%d/%Y %H:%M:%S")
-        dtime_str=nice_sec2str(dtime.total_seconds())
-        ss1="Running     "+idx
-        ss2="Checked at "+ctime_str
-        ss3="Running time: "+dtime_str
-        message=ss1+"\n"+ss2+"\n"+ss3
-        return Fjob(path,status,message)
-
-    def create_wait_job(qjob,path):
-        status="qw"
-        idx=qjob.idx
-        ss1="Waiting     "+idx
-        ctime=datetime.datetime.now() # current time
-        stime=qjob.btime  # job submission time      
-        dtime=ctime-stime
-
-        ctime_str=datetime.datetime.strftime(ctime,
-                                 "%m/%d/%Y %H:%M:%S")
-        dtime_str=nice_sec2str(dtime.total_seconds())
-        if dtime.total_seconds()>3600:
-            ss1="Waiting and kill   "+idx
-
-        ss2="Checked at "+ctime_str
-        ss3="Waiting time: "+dtime_str
-        message=ss1+"\n"+ss2+"\n"+ss3
-        return Fjob(path,status,message)
-
-    def create_error_job(qjob,path):
-        status="Eqw"
-        idx=qjob.idx
-        ctime=datetime.datetime.now()
-        ctime_str=datetime.datetime.strftime(ctime,
-                                             "%m/%d/%Y %H:%M:%S")
-    
-        ss1="Error     "+idx+" Will kill and resubmit"
-        ss2="Checked at "+ctime_str
-        message=ss1+"\n"+ss2
-        return Fjob(path,status,message)             
+            message=self._message
+        if self.kill_result is not None:
+            message+="\nqdel {}: {}".format(self.idx,self.kill_result)
+        return message
+
+    @message.setter
+    def message(self,message):
+        self._message=message
+
+    def _render(self):
+        status=self.status
+        idx=self.idx
+        if status=='d':
+            idx=idx or job_done_id(self.folder)
+            info=read_job_info(idx,self.folder)
+            if len(info)>2:
+                dtime=info[2]-info[1]
+                return "Done\nSimulation time "+nice_sec2str(
+                    dtime.total_seconds())
+            return "Done\nSimulation time unknown"
+        if status=='nd':
+            return 'Not running\nChecked at '+time_str(self.ctime)
+        if status=='r':
+            ss="Running     "+idx+"\nChecked at "+time_str(self.ctime)
+            ss+="\n"+self.running_time()
+            if self.eta is not None:
+                ss+="\n"+self.eta_str()
+            return ss
+        if status=='qw':
+            dtime=self.ctime-self.qjobs[0].btime
+            if self.kill:
+                ss1="Waiting and kill   "+idx
+            else:
+                ss1="Waiting     "+idx
+            return ss1+"\nChecked at "+time_str(self.ctime)+ \
+                "\nWaiting time: "+nice_sec2str(dtime.total_seconds())
+        if status=='Eqw':
+            return "Error     "+idx+" Will kill and resubmit"+ \
+                "\nChecked at "+time_str(self.ctime)
+        if status=='p':
+            return '\n'.join(["More than one jobs in the folder"]+
+                             [str(job) for job in self.qjobs])
+        return "Unknown status ({}) of  {}".format(self.qjobs[0].status,idx)
+
+    def as_dict(self):
+        def iso(t):
+            return t.isoformat() if t is not None else None
+        return {'folder':self.folder,'status':self.status.value,
+                'idx':self.idx,'btime':iso(self.btime),
+                'ctime':iso(self.ctime),'eta':iso(self.eta),
+                'kill':self.kill,
+                'kill_result':self.kill_result,
+                'qjobs':[qjob.idx for qjob in self.qjobs]}
+
+    def eta_str(self):
+        left=(self.eta-self.ctime).total_seconds()
+        if left<0:
+            return "Expected end: "+time_str(self.eta)+" (overdue)"
+        return "Expected end: "+time_str(self.eta)+" (in "+ \
+            nice_sec2str(left).strip()+")"
+
+    def running_time(self):
+        if self.btime is None:
+            return "Running time: unknown"
+        dtime=self.ctime-self.btime
+        return "Running time: "+nice_sec2str(dtime.total_seconds())
+
+    # class method, to create all kinds of Fjob, ctime is the time of
+    # the check, now if not given
+    def create_done_job(path,ctime=None):
+        # job.info is only read if the message is needed
+        return Fjob(path,'d',ctime=ctime)
+
+    def create_not_done_job(path,ctime=None):
+        ctime=ctime or datetime.datetime.now()
+        return Fjob(path,'nd',ctime=ctime)
 
-    def create_unknown_job(qjob,path):
-        status=qjob.status
-        idx=qjob.idx
-        message="Unknown status ({}) of  {}".format(status,idx)
-        return Fjob(path,status,message)             
+    def create_run_job(qjob,path,ctime=None,probe=None):
+        ctime=ctime or datetime.datetime.now()
+        # job.info has the job id, also for a task of an array job
+        info=read_job_info(job_number(qjob.idx),path,probe)
+        btime=info[1] if len(info)>1 else None
+        return Fjob(path,'r',idx=qjob.idx,qjobs=(qjob,),btime=btime,
+                    ctime=ctime)
 
-    def create_plural_job(qjobs,path):
-        status='p'
-        message="More than one jobs in the folder"
-        for job in qjobs:
-            message+='\n'+str(job)
-        return Fjob(path,status,message)    
+    def create_wait_job(qjob,path,ctime=None,max_wait=3600):
+        ctime=ctime or datetime.datetime.now()
+        dtime=ctime-qjob.btime  # qjob.btime is the submission time
+        return Fjob(path,'qw',idx=qjob.idx,qjobs=(qjob,),ctime=ctime,
+                    kill=dtime.total_seconds()>max_wait)
+
+    def create_error_job(qjob,path,ctime=None):
+        ctime=ctime or datetime.datetime.now()
+        return Fjob(path,'Eqw',idx=qjob.idx,qjobs=(qjob,),ctime=ctime,
+                    kill=True)
+
+    def create_unknown_job(qjob,path,ctime=None):
+        return Fjob(path,'un',idx=qjob.idx,qjobs=(qjob,),ctime=ctime)
+
+    def create_plural_job(qjobs,path,ctime=None):
+        return Fjob(path,'p',qjobs=qjobs,ctime=ctime)
 
 
 class Fjob_list:
@@ -517,26 +3085,42 @@ class Fjob_list:
         self.fjobs=[]
         self.n_del=0
         self.n_sub=0
+        # actions of this tick, to update the queue snapshot
+        self.killed=[]
+        self.submitted=[]
+        # the folders of the jobs killed or submitted in this tick
+        self.acted=set()
+        # root of the check -> the root of its manifest, None for none,
+        # found once per check for the submitted folders
+        self.manifests={}
+        # folder -> position in fjobs
+        self.index={}
+        # status -> number of folders
+        self.counts=collections.Counter()
+        # time of the check, shared by the folders of a tick
+        self.ctime=None
+        # the Backends of the jobs to kill and resubmit, and to submit,
+        # after the walk
+        self.backends=Backends(SgeBackend(KillQueue(),SubmitQueue()))
+        # the job History, for the kill thresholds, the ETAs and the
+        # running times
+        self.history=None
        
     def __str__(self):
-        ss=""
-        for job in self.fjobs:
-            if job.status!='d': 
-                ss=ss+str(job)+"\n"
-        ss=ss[:-1]
-        return ss
+        return "\n".join(str(job) for job in self.fjobs if job.status!='d')
+    # a folder already in the list is replaced
     def append(self,sjob):
-        self.fjobs.append(sjob) 
+        n=self.index.get(sjob.folder)
+        if n is None:
+            self.index[sjob.folder]=len(self.fjobs)
+            self.fjobs.append(sjob) 
+        else:
+            self.counts[self.fjobs[n].status]-=1
+            self.fjobs[n]=sjob
+        self.counts[sjob.status]+=1
 
     def dict_jobs(self):
-        all_status=set(('d','nd','r','qw','Eqw','p','un'))
-        dict={key:0 for key in all_status}
-        for job in self.fjobs:
-            if job.status in all_status:
-                dict[job.status]+=1
-            else:
-                dict['un']+=1
-        return dict
+        return {str(key):self.counts[key] for key in Status}
 
     def summary(self):
         n=len(self.fjobs)
@@ -554,138 +3138,408 @@ class Fjob_list:
             ss+='{} jobs are funny'.format(dict['un'])
         return ss
 
-    def walk_and_build(self,path,qjobs):
-        nUI=qjobs.UI_usage()
-        os.chdir(path)
-        folders=[x[0] for x in os.walk(path)]
-        folders.sort()
+    # read the job files of a folder and classify it, nothing is
+    # changed here so it can run in a worker thread
+    # probe: the FolderProbe of the folder if already taken, otherwise
+    # the folder is listed here, once
+    # return the Fjob and the signature of the job files
+    def classify(self,folder,qjobs_folder,state=None,full=False,
+                 probe=None):
+        sig=None
+        ctime=self.ctime
+        if probe is None:
+            probe=probe_folder(folder)
+        if len(qjobs_folder)==0:
+            # no standing job, either done or not finished
+            cached=None
+            if state is not None:
+                sig=probe.signature
+                if not full:
+                    cached=state.get(folder,sig)
+            if cached and cached[0]=='d':
+                # the message is written again if it was not kept
+                fjob=Fjob(folder,'d',cached[1] or None)
+            elif cached is None and is_finished_from_job_file(folder,
+                                                              probe):
+                fjob=Fjob.create_done_job(folder,ctime)
+            else:
+                fjob=Fjob.create_not_done_job(folder,ctime)
+        elif len(qjobs_folder)==1:
+            #one job, it is good
+            qjob=qjobs_folder[0]
+            status=qjob.status
+            if status=='r':
+                fjob=Fjob.create_run_job(qjob,folder,ctime,probe)
+            elif status=="qw":
+                fjob=Fjob.create_wait_job(qjob,folder,ctime)
+            elif status=="Eqw":
+                fjob=Fjob.create_error_job(qjob,folder,ctime)
+            else:
+                fjob=Fjob.create_unknown_job(qjob,folder,ctime)
+        else:
+            # more than one job, report it
+            fjob=Fjob.create_plural_job(qjobs_folder,folder,ctime)
+        fjob.probe=probe
+        return fjob,sig
+
+    # report a classified folder and take the actions, always in the
+    # main thread and in the order of the folders
+    def act(self,fjob,qjobs_folder,qjobs,state=None,sig=None):
+        folder=fjob.folder
+        if self.history is not None and len(qjobs_folder)==1:
+            # decided here and not in classify, where the history is
+            qjob=qjobs_folder[0]
+            if fjob.status=='qw':
+                wait=(fjob.ctime-qjob.btime).total_seconds()
+                fjob.kill=wait>self.history.kill_threshold(qjob.server,
+                                                           folder)
+            elif fjob.status=='r':
+                fjob.eta=self.history.eta(folder,fjob.btime or qjob.btime)
+        if state is not None and len(qjobs_folder)==0:
+            # the message of a done folder is written when needed
+            state.put(folder,fjob.status,sig,'')
+        if fjob.status!='d':
+            print('---------------------')
+            print(folder)
+            print(fjob.message)
+
+        if fjob.status=='nd':
+            # Action: resubmit
+            self.resubmit(qjobs,fjob)
+        elif len(qjobs_folder)==1 and fjob.kill:
+            # Action: kill it and resubmit, after the walk
+            self.backends.kill(qjobs_folder[0].idx,fjob)
+        # only a folder to resubmit after its kill needs its listing
+        if not (len(qjobs_folder)==1 and fjob.kill):
+            fjob.probe=None
+        self.append(fjob)
+
+    # kill the jobs requested in the walk, resubmit the folders whose
+    # job is surely gone
+    def flush_kills(self,qjobs,timeout=60):
+        fjobs=self.backends.requests()
+        if not fjobs:
+            return
+        self._after_kills(qjobs,fjobs,self.backends.flush(timeout))
+
+    async def aflush_kills(self,qjobs,timeout=60):
+        fjobs=self.backends.requests()
+        if not fjobs:
+            return
+        self._after_kills(qjobs,fjobs,await self.backends.aflush(timeout))
+
+    def _after_kills(self,qjobs,fjobs,outcome):
+        for idx,fjob in fjobs.items():
+            result=outcome[idx]
+            if result not in ('killed','gone'):
+                print("Job {} not killed ({}), resubmit later".format(
+                    idx,result))
+                fjob.probe=None
+                continue
+            qjobs.remove(idx)
+            self.killed.append(idx)
+            self.acted.add(fjob.folder)
+            if self.history is not None:
+                self.history.record_kill(idx,fjob.folder)
+            self.resubmit(qjobs,fjob)
+            fjob.probe=None
+
+    # submit the job scripts of a folder again, to the backend that
+    # takes them for their running time
+    def resubmit(self,qjobs,fjob):
+        runtime=None
+        if self.history is not None:
+            runtime=self.history.runtime(fjob.folder)
+        submit_job_based_Q(q=qjobs,path=fjob.folder,backends=self.backends,
+                           probe=fjob.probe,runtime=runtime,
+                           manifest=self.manifest_of(fjob.folder))
+
+    # the root of the manifest of a folder, from the roots of the check,
+    # True to look for it if the folder is in none of them
+    def manifest_of(self,folder):
+        for root,top in self.manifests.items():
+            if in_tree(folder,root):
+                return top
+        return True
+
+    # submit everything queued in the walk
+    def flush_submits(self,qjobs):
+        self._after_submits(qjobs,self.backends.run())
+
+    async def aflush_submits(self,qjobs,timeout=60):
+        self._after_submits(qjobs,await self.backends.arun(timeout))
+
+    def _after_submits(self,qjobs,results):
+        for (folder,script,server),idx,line,error in results:
+            qjobs.release(server)
+            if error is not None:
+                print("Submitting {} failed: {}".format(script,error))
+                continue
+            record_submission(folder,server,idx,line,qjobs,
+                              manifest=self.manifest_of(folder))
+            self.acted.add(folder)
+            if idx:
+                self.submitted.append((idx,server))
+                if self.history is not None:
+                    self.history.record_submit(idx,os.path.abspath(folder),
+                                               server)
 
-        for folder in folders:
-            os.chdir(folder)
-            # a working folder is a folder with job.begin
-            if os.path.isfile('job.begin'):
+    # state: a ScanState to skip the folders not changed since the
+    # last tick, full: read every folder again anyway, workers: number
+    # of threads reading the folders, the other arguments are passed to
+    # iter_job_folders; the new jobs are placed by the queue load
+    # unless qjobs has a placement already
+    def walk_and_build(self,path,qjobs,state=None,full=False,
+                       stop_at_job=True,ignore=(),max_depth=None,
+                       workers=1):
+        if qjobs.placement is None:
+            qjobs.placement=take_placement(self.history)
+        self.manifests={path:find_manifest(path)}
+        probes={}
+        folders=iter_job_folders(path,stop_at_job,ignore,max_depth,
+                                 probes=probes)
+        self.build(folders,qjobs,state,full,workers,probes=probes)
+
+    # build the list from the given job folders, flush: kill and submit
+    # right away, otherwise the caller does, probes: folder ->
+    # FolderProbe of the folders already listed
+    def build(self,folders,qjobs,state=None,full=False,workers=1,
+              flush=True,probes=None):
+        self.ctime=datetime.datetime.now()
+        probes=probes or {}
+        if workers<=1:
+            for folder in folders:
                 qjobs_folder=qjobs.find_base_folder(folder)
-                if len(qjobs_folder)==0:
-                    # no standing job, either done or not finished
-                    if is_finished_from_job_file(folder):
-                        fjob=Fjob.create_done_job(folder)
-                        # print(fjob.message)
-                    else:
-                        print('---------------------')
-                        print(folder)
-                        fjob=Fjob.create_not_done_job(folder)
-                        print(fjob.message)
-                        # Action: resubmit
-                        submit_job_based_Q(q=qjobs,path='./')
-                        # if nUI<5:
-                        #     submit_job(server="UI")
-                        #     nUI=nUI+1
-                        # else:
-                        #     submit_job(server="all.q")
-                        
-                        
-                elif len(qjobs_folder)==1:
-                    print('---------------------')
-                    print(folder)
-                    #one job, it is good
-                    qjob=qjobs_folder[0]
-                    status=qjob.status
-                    idx=qjob.idx
-                    if status=='r':
-                        fjob=Fjob.create_run_job(qjob,folder)
-                        print(fjob.message)
-                    elif status=="qw":
-                        fjob=Fjob.create_wait_job(qjob,folder)
-                        print(fjob.message)
-                        if re.search('kill',fjob.message, re.M|re.I):
-                            kill_job(qjob.idx)
-                            submit_job_based_Q(q=qjobs,path='./')
-                            # if nUI<2:
-                            #     submit_job(server="UI")
-                            #     nUI=nUI+1
-                            # else:
-                            #     submit_job(server="all.q")
-                    elif status=="Eqw":
-                        fjob=Fjob.create_error_job(qjob,folder)
-                        print(fjob.message)
-                        # Action: kill it and resubmit
-                        kill_job(qjob.idx)
-                        submit_job_based_Q(q=qjobs,path='./')
-                        # if nUI<2:
-                        #     submit_job(server="UI")
-                        #     nUI=nUI+1
-                        # else:
-                        #     submit_job(server="all.q")
-                    else:
-                        fjob=Fjob.create_unknown_job(qjob,folder)
-                        print(fjob.message)
-                else:
-                    # more than one job, report it
-                    print('---------------------')
-                    print(folder)
-                    fjob=Fjob.create_plural_job(qjobs_folder,folder)
-                    print(fjob.message)
-                    
-                self.fjobs.append(fjob)
-                os.chdir(path)
+                if qjobs_folder and state is not None:
+                    # a folder with a queued job is always read again
+                    state.forget(folder)
+                fjob,sig=self.classify(folder,qjobs_folder,state,full,
+                                       probes.get(folder))
+                self.act(fjob,qjobs_folder,qjobs,state,sig)
+        else:
+            # the folders are read in parallel, but the results are
+            # taken in order and the actions are done here one by one
+            pending=collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                for folder in folders:
+                    qjobs_folder=qjobs.find_base_folder(folder)
+                    if qjobs_folder and state is not None:
+                        state.forget(folder)
+                    future=pool.submit(self.classify,folder,qjobs_folder,
+                                       state,full,probes.get(folder))
+                    pending.append((future,qjobs_folder))
+                    while len(pending)>=4*workers:
+                        future,qjobs_folder=pending.popleft()
+                        fjob,sig=future.result()
+                        self.act(fjob,qjobs_folder,qjobs,state,sig)
+                while pending:
+                    future,qjobs_folder=pending.popleft()
+                    fjob,sig=future.result()
+                    self.act(fjob,qjobs_folder,qjobs,state,sig)
+        if flush:
+            self.flush_kills(qjobs)
+            self.flush_submits(qjobs)
+
+    # build the list from several roots: the folders are split into
+    # subtrees which are walked and classified in a process pool, then
+    # the actions are taken here in the order of the folders; states is
+    # root -> ScanState
+    def build_sharded(self,roots,qjobs,snapshot,states,full=False,
+                      processes=None,stop_at_job=True,ignore=(),
+                      max_depth=None,flush=False):
+        self.ctime=datetime.datetime.now()
+        processes=processes or os.cpu_count() or 1
+        folders={job.idx:job.folder for job in qjobs.qjobs if job.folder}
+        tasks=[]
+        results=[]
+        with concurrent.futures.ProcessPoolExecutor(
+                processes,initializer=_init_shard_worker,
+                initargs=(snapshot,folders,self.ctime)) as pool:
+            for root in roots:
+                listed=manifest_folders(root,stop_at_job,ignore,max_depth)
+                if listed is not None:
+                    # a root with a manifest is split into equal parts
+                    size=max(1,-(-len(listed)//(4*processes)))
+                    for n in range(0,len(listed),size):
+                        tasks.append((root,pool.submit(
+                            scan_listed,root,listed[n:n+size],full)))
+                    continue
+                jobs,shards=job_shards(root,stop_at_job,ignore,max_depth,
+                                       4*processes)
+                # the job folders met while splitting are few, read
+                # them here
+                for folder in jobs:
+                    results.append((root,)+self.classify(
+                        folder,qjobs.find_base_folder(folder),states[root],
+                        full))
+                for folder,rel,depth in shards:
+                    tasks.append((root,pool.submit(
+                        scan_shard,root,folder,rel,depth,full,stop_at_job,
+                        ignore,max_depth)))
+            for root,future in tasks:
+                shard,counts=future.result()
+                METRICS.read_file(counts[1],counts[0])
+                METRICS.visit_folder(counts[2])
+                results+=[(root,)+res for res in shard]
+        results.sort(key=lambda res:walk_order(res[1].folder))
+        for root,fjob,sig in results:
+            qjobs_folder=qjobs.find_base_folder(fjob.folder)
+            if qjobs_folder:
+                states[root].forget(fjob.folder)
+            self.act(fjob,qjobs_folder,qjobs,states[root],sig)
+        if flush:
+            self.flush_kills(qjobs)
+            self.flush_submits(qjobs)
 
     def info_normal_jobs(self,status):
         # I don't need do anything here
-        ss=''
         if status not in ('r','w','d','nd'):
-            return ss
-        for job in self.fjobs:
-            if job.status==status: 
-                ss+=job.folder+'\n'
-        return ss
+            return ''
+        return ''.join(job.folder+'\n' for job in self.fjobs
+                       if job.status==status)
 
     def info_running_jobs(self):
         # I don't need do anything here
-        ss=''
-        for job in self.fjobs:
-            if job.status=='r':
-                ss+=job.folder+'\n'
-                m=re.search(r'(Running time.*)',job.message)
-                if m:
-                    ss+=m.group()+'\n'+'--------\n'
-        return ss 
+        return ''.join(job.folder+'\n'+job.running_time()+'\n'+
+                       (job.eta_str()+'\n' if job.eta else '')+'--------\n'
+                       for job in self.fjobs if job.status=='r')
 
     def info_funny_jobs(self):
         # display detailed info here
-        ss=''
-        for job in self.fjobs:
-            if job.status not in ('r','w','d','nd'):
-                ss+=str(job)+'\n'
-        return ss
+        return ''.join(str(job)+'\n' for job in self.fjobs
+                       if job.status not in ('r','w','d','nd'))
 
 ############################
 # main function
 ##############################
-def main(path):
-    # build the queue information
-    print(character_frame('My queue information'))
-    qjobs=Qjob_list()
-    qjobs.myq()
-    qjobs.update_servers()
-    print(qjobs.short_str())
-    # print('-'*50)
-    # print(qjobs)
+# full: read all the folders again instead of trusting the scan state,
+# workers: number of threads reading the folders, the other arguments
+# are passed to iter_job_folders
+# folders and fjobs: only check these folders and update them in fjobs,
+# the Fjob_list of an earlier check
+# last_qjobs: the Qjob_list of an earlier check, the folders of its jobs
+# are not asked again
+# qsub_workers, qsub_rate: parallel qsub calls and qsub calls a second
+# timeout: seconds before a qstat, qsub or qdel call is given up
+# limits: queue -> the most jobs of ours there, on top of default_limits
+# array: submit the folders with the same queue and job script header
+# as one array job
+# local_cores: cores of this machine for the jobs expected to end
+# before they would start in the queue, none if 0
+# return the Qjob_list and Fjob_list after the check
+def main(path,full=False,stop_at_job=True,ignore=(),max_depth=None,
+         workers=1,folders=None,fjobs=None,qsub_workers=4,qsub_rate=10,
+         timeout=300,last_qjobs=None,limits=None,array=False,local_cores=0):
+    METRICS.reset()
+    try:
+        result=asyncio.run(amain(path,full,stop_at_job,ignore,max_depth,
+                                 workers,folders,fjobs,qsub_workers,
+                                 qsub_rate,timeout,last_qjobs,limits,
+                                 array,local_cores))
+    finally:
+        METRICS.finish()
+    # a check of some folders leaves the others in the cache
+    if folders is None:
+        sweep_parse_cache()
+    return result
 
-    # nUI=qjobs.UI_usage()
-    # print("There are {} UI jobs".format(nUI))
+async def amain(path,full=False,stop_at_job=True,ignore=(),max_depth=None,
+                workers=1,folders=None,fjobs=None,qsub_workers=4,
+                qsub_rate=10,timeout=300,last_qjobs=None,limits=None,
+                array=False,local_cores=0):
+    """ The check of main, with the queue, the folder walk and the job
+    files read at the same time """
+    loop=asyncio.get_running_loop()
+    # ask the queue while walking the tree
+    snapshot_task=asyncio.ensure_future(METRICS.timed(
+        'queue',async_take_snapshot(timeout=timeout)))
+    load_task=asyncio.ensure_future(METRICS.timed(
+        'queue_load',async_take_queue_load(timeout)))
+    # the probes of the folders listed in the walk
+    walked={}
+    if folders is None:
+        folders_task=loop.run_in_executor(None,METRICS.timed_call(
+            'walk',find_job_folders,path,stop_at_job,ignore,max_depth,
+            walked))
+    else:
+        folders_task=loop.run_in_executor(None,METRICS.timed_call(
+            'walk',list,folders))
+    try:
+        snapshot=await snapshot_task
+    except BaseException:
+        folders_task.cancel()
+        load_task.cancel()
+        raise
+    snapshot=snapshot.own_arrays(prune_arrays(path,snapshot))
+    # the jobs of the other backends are in the queue as well
+    backends=make_backends(path,local_cores,qsub_workers,qsub_rate,array)
+    snapshot=backends.merge(snapshot)
+    known={}
+    if last_qjobs is not None:
+        known={job.idx:job.folder for job in last_qjobs.qjobs if job.folder}
+    known.update(backends.folders())
+    qjobs=Qjob_list(limits)
+    qjobs.myq(snapshot,folders=False)
+
+    # find the job folders while the job files are read
+    state=ScanState(path)
+    history=History(path)
+    try:
+        history.observe(snapshot)
+        qjobs.placement=await async_placement(history,snapshot,load_task)
+        resolve_task=asyncio.ensure_future(METRICS.timed(
+            'job_folders',qjobs.aget_folders(timeout,known)))
+        folders=await folders_task
+        probes_task=loop.run_in_executor(None,METRICS.timed_call(
+            'read_job_files',prefetch_job_files,folders,state,full,
+            max(workers,4),walked))
+        await resolve_task
+        probes=await probes_task
+        # the listed folders without a job.begin are no job folders
+        folders=[folder for folder in folders
+                 if probes[folder].stat('job.begin')]
+        history.set_folders(qjobs)
+
+        print_queue(qjobs)
+
+        # visit all the simulation folders 
+        print(character_frame('Walk through simulation folders'))
+        if fjobs is None:
+            fjobs=Fjob_list()
+        fjobs.killed=[]
+        fjobs.submitted=[]
+        fjobs.acted=set()
+        fjobs.manifests={path:find_manifest(path)}
+        # the requests left by a tick that failed are not sent now
+        fjobs.backends=backends
+        fjobs.history=history
+        with METRICS.phase('classify'):
+            fjobs.build(folders,qjobs,state,full,workers,flush=False,
+                        probes=probes)
+        await METRICS.timed('qdel',fjobs.aflush_kills(qjobs,timeout))
+        await METRICS.timed('qsub',fjobs.aflush_submits(qjobs,timeout))
+        with METRICS.phase('save_state'):
+            state.commit()
+            history.commit()
+            backends.save()
+    finally:
+        state.close()
+        history.close()
+    await print_report(qjobs,fjobs,snapshot,timeout)
+    return qjobs,fjobs
 
+# the queue section of the report
+def print_queue(qjobs):
+    print(character_frame('My queue information'))
+    print(qjobs.short_str())
     for x,y in qjobs.servers.items():
         print("{} queue has {} jobs".format(x,y))
-        
     print("{} jobs running; {} jobs submitted\n".format(
         qjobs.n_rjobs(),qjobs.n_jobs()))
 
-    
-    # visit all the simulation folders 
-    print(character_frame('Walk through simulation folders'))
-    fjobs=Fjob_list()
-    fjobs.walk_and_build(path,qjobs)
-    os.chdir(path)
+# the folder sections and the summary of the report, snapshot is the
+# queue before the kills and submissions of the check
+async def print_report(qjobs,fjobs,snapshot,timeout=300):
     print(' ')
 
     ss=fjobs.info_running_jobs()
@@ -710,8 +3564,13 @@ def main(path):
         print(ss)
 
     print(character_frame('Summary'))
+    # only the jobs changed in this tick are asked again
+    alive=await METRICS.timed('summary',async_bulk_job_folders(
+        (job_number(idx) for idx,server in fjobs.submitted),timeout=timeout))
+    snapshot=fjobs.backends.merge(
+        snapshot.updated(fjobs.killed,fjobs.submitted,alive))
     qjobs2=Qjob_list()
-    qjobs2.myq_without_folder()
+    qjobs2.myq_without_folder(snapshot)
     qjobs2.update_servers()
     # print("There are {} UI qjobs".format(nUI))
     for x,y in qjobs.servers.items():
@@ -720,22 +3579,1021 @@ def main(path):
         qjobs2.n_rjobs(),qjobs2.n_jobs()))
     print(fjobs.summary())
 
+
+##################################################
+# sharded check of several roots
+###################################################
+# roots: the roots of the job folders, each with its own scan state
+# processes: number of processes walking and reading the folders,
+# the other arguments are those of main
+# return the Qjob_list and Fjob_list after the check
+def main_sharded(roots,processes=None,full=False,stop_at_job=True,
+                 ignore=(),max_depth=None,qsub_workers=4,qsub_rate=10,
+                 timeout=300,limits=None,array=False,local_cores=0):
+    METRICS.reset()
+    try:
+        result=asyncio.run(amain_sharded(roots,processes,full,stop_at_job,
+                                         ignore,max_depth,qsub_workers,
+                                         qsub_rate,timeout,limits,array,
+                                         local_cores))
+    finally:
+        METRICS.finish()
+    sweep_parse_cache()
+    return result
+
+async def amain_sharded(roots,processes=None,full=False,stop_at_job=True,
+                        ignore=(),max_depth=None,qsub_workers=4,
+                        qsub_rate=10,timeout=300,limits=None,array=False,
+                        local_cores=0):
+    """ The check of main_sharded: one queue snapshot for all the roots,
+    the folders split into subtrees classified in a process pool, and
+    the actions taken here in the order of the folders """
+    roots=[os.path.abspath(root) for root in roots]
+    # a root inside another one is checked with it
+    roots=[root for root in roots 
+           if not any(root!=other and root.startswith(other+os.sep)
+                      for other in roots)]
+    roots=list(collections.OrderedDict.fromkeys(roots))
+    load_task=asyncio.ensure_future(METRICS.timed(
+        'queue_load',async_take_queue_load(timeout)))
+    try:
+        snapshot=await METRICS.timed('queue',async_take_snapshot(
+            timeout=timeout))
+    except BaseException:
+        load_task.cancel()
+        raise
+    # the history, the array jobs and the local jobs are kept in the
+    # first root
+    snapshot=snapshot.own_arrays(prune_arrays(roots[0],snapshot))
+    backends=make_backends(roots[0],local_cores,qsub_workers,qsub_rate,
+                           array)
+    snapshot=backends.merge(snapshot)
+    qjobs=Qjob_list(limits)
+    qjobs.myq(snapshot,folders=False)
+    history=History(roots[0])
+    states=collections.OrderedDict()
+    try:
+        history.observe(snapshot)
+        qjobs.placement=await async_placement(history,snapshot,load_task)
+        await METRICS.timed('job_folders',qjobs.aget_folders(
+            timeout,backends.folders()))
+        history.set_folders(qjobs)
+        print_queue(qjobs)
+
+        print(character_frame('Walk through simulation folders'))
+        fjobs=Fjob_list()
+        fjobs.manifests={root:find_manifest(root) for root in roots}
+        fjobs.backends=backends
+        fjobs.history=history
+        for root in roots:
+            states[root]=ScanState(root)
+        with METRICS.phase('classify'):
+            fjobs.build_sharded(roots,qjobs,snapshot,states,full,processes,
+                                stop_at_job,ignore,max_depth)
+        await METRICS.timed('qdel',fjobs.aflush_kills(qjobs,timeout))
+        await METRICS.timed('qsub',fjobs.aflush_submits(qjobs,timeout))
+        with METRICS.phase('save_state'):
+            for state in states.values():
+                state.commit()
+            history.commit()
+            backends.save()
+    finally:
+        for state in states.values():
+            state.close()
+        history.close()
+    await print_report(qjobs,fjobs,snapshot,timeout)
+    return qjobs,fjobs
+
+def job_shards(path,stop_at_job=True,ignore=(),max_depth=None,shards=64,
+               levels=3):
+    """ Split the folders below path into subtrees walked apart
+
+    The tree is listed level by level until there are at least shards
+    subtrees or levels levels are listed.
+
+    Args:
+        path (string): the root
+        stop_at_job (bool): as in iter_job_folders
+        ignore (iterable): as in iter_job_folders
+        max_depth (int): as in iter_job_folders
+        shards (int): how many subtrees are enough
+        levels (int): how many levels to list at most
+
+    Returns:
+        tuple: (jobs, subtrees), the job folders met while listing and
+        the (folder, path relative to the root, depth) of the subtrees
+
+    """
+    path=os.path.abspath(path)
+    ignore=tuple(ignore)
+    jobs=[]
+    level=[(path,'',0)]
+    for n in range(levels):
+        if len(level)>=shards:
+            break
+        next_level=[]
+        for folder,rel,depth in level:
+            if max_depth is not None and depth>=max_depth:
+                next_level.append((folder,rel,depth))
+                continue
+            METRICS.visit_folder()
+            try:
+                with os.scandir(folder) as it:
+                    entries=list(it)
+            except OSError:
+                continue
+            subdirs=[]
+            is_job=False
+            for entry in entries:
+                try:
+                    if entry.name=='job.begin' and entry.is_file():
+                        is_job=True
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                except OSError:
+                    pass
+            if is_job:
+                jobs.append(folder)
+                if stop_at_job:
+                    continue
+            for name in sorted(subdirs):
+                sub_rel=os.path.join(rel,name) if rel else name
+                if not any(fnmatch.fnmatch(name,pattern) or 
+                           fnmatch.fnmatch(sub_rel,pattern) 
+                           for pattern in ignore):
+                    next_level.append((os.path.join(folder,name),sub_rel,
+                                       depth+1))
+        level=next_level
+    return jobs,level
+
+# what a worker process of the sharded check needs, set once by
+# _init_shard_worker: the queue, an Fjob_list to classify with and the
+# scan states of the roots
+_shard_context={}
+
+def _init_shard_worker(snapshot,folders,ctime):
+    qjobs=Qjob_list()
+    qjobs.myq(snapshot,folders=False)
+    for job in qjobs.qjobs:
+        qjobs.set_folder(job,folders.get(job.idx))
+    fjobs=Fjob_list()
+    fjobs.ctime=ctime
+    _shard_context.update(qjobs=qjobs,fjobs=fjobs,states={})
+
+def scan_shard(root,folder,rel,depth,full=False,stop_at_job=True,
+               ignore=(),max_depth=None):
+    """ Walk a subtree and classify its job folders, in a worker
+
+    Returns:
+        tuple: ([(fjob, sig)], metrics), metrics are the files opened,
+        bytes read and folders visited
+
+    """
+    if max_depth is not None:
+        max_depth-=depth
+    probes={}
+    return _classify_shard(root,iter_job_folders(folder,stop_at_job,ignore,
+                                                 max_depth,prefix=rel,
+                                                 probes=probes),full,probes)
+
+def scan_listed(root,folders,full=False):
+    """ Classify a part of the job folders of a manifest, in a worker
+
+    Returns:
+        tuple: as scan_shard
+
+    """
+    probes={folder:probe_folder(folder) for folder in folders}
+    return _classify_shard(root,[folder for folder in folders 
+                                 if probes[folder].stat('job.begin')],
+                           full,probes)
+
+def _classify_shard(root,folders,full,probes=None):
+    METRICS.reset()
+    probes=probes or {}
+    qjobs=_shard_context['qjobs']
+    fjobs=_shard_context['fjobs']
+    states=_shard_context['states']
+    if root not in states:
+        states[root]=ScanState(root)
+    results=[]
+    for job_folder in folders:
+        qjobs_folder=qjobs.find_base_folder(job_folder)
+        results.append(fjobs.classify(job_folder,qjobs_folder,states[root],
+                                      full,probes.get(job_folder)))
+    return results,(METRICS.files_opened,METRICS.bytes_read,
+                    METRICS.folders_visited)
+
+# the key to sort folders the way iter_job_folders yields them
+def walk_order(folder):
+    return folder.split(os.sep)
+
+
+##################################################
+# asyncio versions of the scheduler calls
+###################################################
+async def run_command(comm,timeout=60,cwd=None,check=True,
+                      stderr=subprocess.DEVNULL):
+    """ Run a command with asyncio and return its output
+
+    The command is killed when it takes longer than timeout or the
+    caller is cancelled.
+
+    Args:
+        comm (list): the command
+        timeout (float): seconds to wait
+        cwd (string): the folder to run in
+        check (bool): raise CalledProcessError on a non zero exit code
+        stderr: where stderr goes, subprocess.STDOUT to keep it
+
+    Returns:
+        bytes: the output
+
+    Raises:
+        asyncio.TimeoutError: the command took too long
+
+    """
+    t0=time.perf_counter()
+    proc=await asyncio.create_subprocess_exec(
+        *comm,stdout=subprocess.PIPE,stderr=stderr,cwd=cwd)
+    try:
+        out,err=await asyncio.wait_for(proc.communicate(),timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    finally:
+        METRICS.add_command(comm,time.perf_counter()-t0)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode,comm,out)
+    return out
+
+async def async_take_snapshot(user=None,timeout=60,fresh=False):
+    if user is None:
+        user=getpass.getuser()
+    out=await async_query_output(['qstat','-xml','-r','-u',user],timeout,
+                                 fresh=fresh)
+    records=parse_qstat_xml(io.BytesIO(out))
+    return Qsnapshot(tuple(records),datetime.datetime.now())
+
+async def async_take_queue_load(timeout=60):
+    out=await async_query_output(['qstat','-g','c'],timeout)
+    return parse_qstat_gc(out.decode("utf-8","replace"))
+
+# the placement of a check: the waits of the history, the snapshot and
+# the queue load, {} if qstat -g c failed
+async def async_placement(history,snapshot,load_task):
+    placement=Placement(waits=history.waits())
+    placement.observe(snapshot)
+    try:
+        placement.load=await load_task
+    except (OSError,subprocess.CalledProcessError,asyncio.TimeoutError):
+        placement.load={}
+    return placement
+
+async def async_bulk_job_folders(idxes,chunk=500,timeout=60):
+    """ bulk_job_folders with all the qstat calls at the same time """
+    idxes=list(dict.fromkeys(idxes))
+    chunks=[idxes[i:i+chunk] for i in range(0,len(idxes),chunk)]
+    # qstat returns 1 if some of the jobs are gone, it is fine
+    results=await asyncio.gather(
+        *(async_query_output(['qstat','-j',','.join(c)],timeout,check=False)
+          for c in chunks),return_exceptions=True)
+    folders={}
+    for res in results:
+        if isinstance(res,BaseException):
+            continue
+        _read_job_folders(res.decode("utf-8","replace").splitlines(),
+                          folders)
+    return folders
+
+# read the job files of the folders into the parse cache, skipping the
+# folders the scan state already knows
+# return folder -> FolderProbe, for the classification; probes: the
+# probes of the folders listed already, the others are listed here
+def prefetch_job_files(folders,state=None,full=False,workers=4,
+                       probes=None):
+    probes=probes or {}
+    def read(folder):
+        probe=probes.get(folder) or probe_folder(folder)
+        if state is not None and not full and \
+           state.get(folder,probe.signature) is not None:
+            return probe
+        # job.info of a finished folder is only read for its message
+        if not is_finished_from_job_file(folder,probe):
+            job_info_times(folder,probe)
+        return probe
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return dict(zip(folders,pool.map(read,folders)))
+
+##################################################
+# watch mode with inotify
+###################################################
+class Inotify:
+    """ A small ctypes wrapper of the Linux inotify API """
+    IN_CLOSE_WRITE=0x00000008
+    IN_MOVED_TO=0x00000080
+    IN_DELETE=0x00000200
+    IN_IGNORED=0x00008000
+    mask=IN_CLOSE_WRITE|IN_MOVED_TO|IN_DELETE
+
+    def __init__(self):
+        libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                         use_errno=True)
+        self._add_watch=libc.inotify_add_watch
+        self._add_watch.argtypes=[ctypes.c_int,ctypes.c_char_p,
+                                  ctypes.c_uint32]
+        self.fd=libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd<0:
+            e=ctypes.get_errno()
+            raise OSError(e,os.strerror(e))
+        self.folders={}  # wd -> folder
+        self.wds={}      # folder -> wd
+
+    def add_watch(self,folder):
+        """ Watch the files in a folder
+
+        Returns:
+            bool: False if the folder can not be watched
+
+        Raises:
+            OSError: ENOSPC when no more watches are allowed
+
+        """
+        if folder in self.wds:
+            return True
+        wd=self._add_watch(self.fd,os.fsencode(folder),self.mask)
+        if wd<0:
+            e=ctypes.get_errno()
+            if e==errno.ENOSPC:
+                raise OSError(e,os.strerror(e))
+            return False
+        self.folders[wd]=folder
+        self.wds[folder]=wd
+        return True
+
+    def read_events(self,timeout):
+        """ Wait for events at most timeout seconds
+
+        Returns:
+            list: (folder,name) of the changed files
+
+        """
+        events=[]
+        r,w,x=select.select([self.fd],[],[],max(timeout,0))
+        if not r:
+            return events
+        while True:
+            try:
+                data=os.read(self.fd,65536)
+            except BlockingIOError:
+                break
+            i=0
+            while i+16<=len(data):
+                wd,mask,cookie,n=struct.unpack_from('iIII',data,i)
+                name=data[i+16:i+16+n].rstrip(b'\0').decode('utf-8',
+                                                             'replace')
+                i+=16+n
+                if mask & self.IN_IGNORED:
+                    folder=self.folders.pop(wd,None)
+                    self.wds.pop(folder,None)
+                elif wd in self.folders:
+                    events.append((self.folders[wd],name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(path,report='currentjob.txt',reconcile=1800,poll=60,debounce=5,
+          server=None,**options):
+    """ Check the job folders whenever their job files change
+
+    After a full check, the folders not done yet are watched with
+    inotify and a folder is checked again a few seconds after its
+    job.begin, job.done or job.info changes.  As a safety net, the queue
+    is asked every poll seconds and the folders of the jobs that left
+    the queue or changed state are checked as well; this is what catches
+    files written from other hosts on network filesystems, which inotify
+    does not see.  The whole tree is checked every reconcile seconds.
+    A check holds the tick lock of the tree; a check that fails or
+    finds the lock taken is tried again after poll seconds.  The
+    folders a check kills or submits jobs of are checked again after
+    debounce seconds, and the folders left without a watch when inotify
+    runs out of them are polled for changes of their job files.
+
+    Args:
+        path (string): the root of the job folders
+        report (string): the file to write the report into
+        reconcile (float): seconds between two full checks
+        poll (float): seconds between two queue checks
+        debounce (float): seconds to wait for more changes
+        server (StatusServer): published to after each check
+        **options: passed to main
+
+    """
+    notify=Inotify()
+    full_scan=True
+    full=options.pop('full',False)
+    dirty=set()
+    last_event=0
+    next_poll=time.time()+poll
+    warned=False
+    # folder -> signature of the job files, of the folders not watched
+    unwatched={}
+    while True:
+        # a check that did not run is tried again after poll seconds
+        done=False
+        with tick_lock(path) as locked:
+            if not locked:
+                print('jobcheck: another check is running, try again in '
+                      '{:.0f} s'.format(poll),file=sys.stderr)
+            else:
+                try:
+                    if full_scan:
+                        qjobs,fjobs=profiled(run_to_file,report,main,path,
+                                             full,**options)
+                    else:
+                        qjobs,fjobs=profiled(run_to_file,report,main,path,
+                                             folders=sorted(dirty),
+                                             fjobs=fjobs,**options)
+                    write_status(status_file(report),qjobs,fjobs)
+                    METRICS.write(os.path.dirname(os.path.abspath(report)))
+                    if server is not None:
+                        server.publish(qjobs,fjobs)
+                    done=True
+                except Exception as e:
+                    print('jobcheck: check failed, {!r}'.format(e),
+                          file=sys.stderr)
+        if not done:
+            time.sleep(poll)
+            continue
+        checked=None if full_scan else set(dirty)
+        if full_scan:
+            full=False
+            full_scan=False
+            next_full=time.time()+reconcile
+        dirty.clear()
+        # the job files of the folders acted on changed after the check
+        # and before their watch, look at them again
+        if fjobs.acted:
+            dirty.update(fjobs.acted)
+            last_event=time.time()
+        left={}
+        for fjob in fjobs.fjobs:
+            if fjob.status=='d':
+                continue
+            try:
+                notify.add_watch(fjob.folder)
+            except OSError:
+                if not warned:
+                    print('jobcheck: out of inotify watches, '
+                          'the rest is left to polling',file=sys.stderr)
+                    warned=True
+                if fjob.folder in unwatched and checked is not None and \
+                   fjob.folder not in checked:
+                    left[fjob.folder]=unwatched[fjob.folder]
+                else:
+                    left[fjob.folder]=probe_folder(fjob.folder).signature
+        unwatched=left
+
+        # wait for something to do
+        while True:
+            now=time.time()
+            timeout=min(next_full,next_poll)-now
+            if dirty:
+                timeout=min(timeout,last_event+debounce-now)
+            for folder,name in notify.read_events(timeout):
+                if name in job_files:
+                    dirty.add(folder)
+                    last_event=time.time()
+            now=time.time()
+            if now>=next_full:
+                full_scan=True
+                break
+            if now>=next_poll:
+                next_poll=now+poll
+                try:
+                    snapshot=take_snapshot(timeout=options.get(
+                        'timeout')).own_arrays(submitted_arrays(path))
+                    snapshot=make_backends(
+                        path,options.get('local_cores',0)).merge(snapshot)
+                except Exception as e:
+                    print('jobcheck: queue poll failed, {!r}'.format(e),
+                          file=sys.stderr)
+                    continue
+                # the ids of qjobs, job.task for the tasks of array jobs
+                seen={idx:job.status for idx,job in snapshot.tasks()}
+                for job in qjobs.qjobs:
+                    # the jobs of other trees are left to their jobcheck
+                    if job.folder and in_tree(job.folder,path) and \
+                       seen.get(job.idx)!=job.status:
+                        dirty.add(job.folder)
+                        last_event=now
+                for folder,sig in unwatched.items():
+                    if probe_folder(folder).signature!=sig:
+                        dirty.add(folder)
+                        last_event=now
+            if dirty and now>=last_event+debounce:
+                break
+
+##################################################
+# daemon mode
+###################################################
+def next_interval(fjobs,interval=600,min_interval=60,max_interval=1800,
+                  now=None):
+    """ Seconds to wait before the next check
+
+    Nothing in the queue or to submit: max_interval.  Running jobs
+    expected to end soon (their ETA from the job history): the time
+    left until the first of them ends, at least min_interval.
+    Otherwise interval.
+
+    Args:
+        fjobs (Fjob_list): the folders of the last check
+        interval (float): the usual interval
+        min_interval (float): the shortest interval
+        max_interval (float): the longest interval
+        now (datetime): the current time, now if not given
+
+    Returns:
+        float: seconds
+
+    """
+    if not any(n for status,n in fjobs.counts.items() 
+               if status!=Status.DONE):
+        return max_interval
+    wait=interval
+    now=now or datetime.datetime.now()
+    for fjob in fjobs.fjobs:
+        if fjob.status!='r' or fjob.eta is None:
+            continue
+        left=(fjob.eta-now).total_seconds()
+        # a job well past the usual time tells nothing
+        if left>-interval:
+            wait=min(wait,left)
+    return max(min_interval,min(wait,max_interval))
+
+def daemon(path,report='currentjob.txt',interval=600,min_interval=60,
+           max_interval=1800,reconcile=3600,server=None,**options):
+    """ Check the job folders in a loop, keeping the state in memory
+
+    The queue and the folders of the last check are kept, and a check
+    only reads the folders that are not done yet and the folders of the
+    jobs in the queue; the folders of known jobs are not asked again.
+    The whole tree is checked every reconcile seconds, to find new
+    folders.  The time between two checks follows next_interval.
+    Checks never overlap: a check starts when the last one is over and
+    the tick lock of the tree is held.
+
+    Args:
+        path (string): the root of the job folders
+        report (string): the file to write the report into
+        interval (float): the usual seconds between two checks
+        min_interval (float): the shortest time between two checks
+        max_interval (float): the longest time between two checks
+        reconcile (float): seconds between two full checks
+        server (StatusServer): published to after each check
+        **options: passed to main
+
+    """
+    full=options.pop('full',False)
+    qjobs=fjobs=None
+    next_full=0
+    while True:
+        start=time.time()
+        wait=min_interval
+        with tick_lock(path) as locked:
+            if not locked:
+                print('jobcheck: another check is running, skip this tick',
+                      file=sys.stderr)
+            else:
+                # a failed tick keeps the last state and tries again
+                try:
+                    if fjobs is None or start>=next_full:
+                        qjobs,fjobs=profiled(run_to_file,report,main,path,
+                                             full,last_qjobs=qjobs,
+                                             **options)
+                        full=False
+                        next_full=start+reconcile
+                    else:
+                        folders={fjob.folder for fjob in fjobs.fjobs
+                                 if fjob.status!='d'}
+                        # the jobs of other trees are left to their jobcheck
+                        folders.update(job.folder for job in qjobs.qjobs
+                                       if job.folder and
+                                       in_tree(job.folder,path))
+                        qjobs,fjobs=profiled(run_to_file,report,main,path,
+                                             folders=sorted(folders),
+                                             fjobs=fjobs,last_qjobs=qjobs,
+                                             **options)
+                    write_status(status_file(report),qjobs,fjobs)
+                    METRICS.write(os.path.dirname(os.path.abspath(report)))
+                    if server is not None:
+                        server.publish(qjobs,fjobs)
+                    wait=next_interval(fjobs,interval,min_interval,
+                                       max_interval)
+                    print('jobcheck: next check in {:.0f} s'.format(wait))
+                except Exception as e:
+                    wait=interval
+                    print('jobcheck: check failed, {!r}, next check in '
+                          '{:.0f} s'.format(e,wait),file=sys.stderr)
+        time.sleep(max(0,start+wait-time.time()))
+
+##################################################
+# status queries on a Unix socket
+###################################################
+def status_socket(path,fname='.jobcheck.sock'):
+    """ The Unix socket of the status server of a tree
+
+    Args:
+        path (string): the root of the job folders
+        fname (string): the socket in path
+
+    Returns:
+        string: the socket, in the temporary folder if the path in the
+        tree is too long for a Unix socket
+
+    """
+    path=os.path.abspath(path)
+    sock=os.path.join(path,fname)
+    if len(sock.encode())>100:
+        sock=os.path.join(tempfile.gettempdir(),'jobcheck-{}-{}.sock'.format(
+            os.getuid(),hashlib.sha1(path.encode()).hexdigest()[:16]))
+    return sock
+
+class StatusView:
+    """ The answers of the status server, built once after a check
+
+    Everything is taken from the Qjob_list and the Fjob_list when the
+    view is built, so a query is a dict lookup and never reads a file
+    or asks the queue.  The messages of the folders are not included,
+    they may need job.info.
+
+    Args:
+        qjobs (Qjob_list): the queue at the check
+        fjobs (Fjob_list): the job folders
+
+    """
+    def __init__(self,qjobs,fjobs):
+        self.time=fjobs.ctime.isoformat() if fjobs.ctime else None
+        self.folders={}
+        self.by_status={}
+        for fjob in fjobs.fjobs:
+            doc=fjob.as_dict()
+            self.folders[folder_key(fjob.folder)]=doc
+            self.by_status.setdefault(doc['status'],[]).append(fjob.folder)
+        self.jobs={}
+        for qjob in qjobs.qjobs:
+            doc=qjob.as_dict()
+            fdoc=self.folders.get(folder_key(qjob.folder)) \
+                if qjob.folder else None
+            doc['eta']=fdoc['eta'] if fdoc and fdoc['idx']==qjob.idx \
+                else None
+            self.jobs[qjob.idx]=doc
+        self.summary={'counts':fjobs.dict_jobs(),'text':fjobs.summary(),
+                      'servers':dict(qjobs.servers),
+                      'running':qjobs.n_rjobs(),'submitted':qjobs.n_jobs()}
+
+    def answer(self,request):
+        """ Answer a query
+
+        Args:
+            request (dict): {'query': 'folder', 'folder': absolute path},
+                {'query': 'status', 'status': 'Eqw'}, {'query': 'job',
+                'idx': job id} or {'query': 'summary'}
+
+        Returns:
+            dict: the answer, with 'error' if there is none
+
+        """
+        if not isinstance(request,dict):
+            return {'time':self.time,'error':'bad request: not an object'}
+        for field in ('query','folder','status'):
+            if not isinstance(request.get(field,''),str):
+                return {'time':self.time,'error':
+                        'bad request: {} is not a string'.format(field)}
+        query=request.get('query')
+        if query=='folder':
+            doc=self.folders.get(os.path.normpath(request.get('folder','')))
+            if doc is None:
+                return {'time':self.time,'error':'unknown folder'}
+            return {'time':self.time,'folder':doc}
+        if query=='status':
+            return {'time':self.time,'folders':
+                    self.by_status.get(request.get('status'),[])}
+        if query=='job':
+            doc=self.jobs.get(str(request.get('idx')))
+            if doc is None:
+                return {'time':self.time,'error':'unknown job'}
+            return {'time':self.time,'job':doc}
+        if query=='summary':
+            return dict(self.summary,time=self.time)
+        return {'time':self.time,'error':'unknown query {!r}'.format(query)}
+
+class _StatusHandler(socketserver.StreamRequestHandler):
+    # one JSON request a line, one JSON answer a line
+    def handle(self):
+        for line in self.rfile:
+            view=self.server.view
+            try:
+                request=json.loads(line.decode("utf-8"))
+                if view is None:
+                    answer={'error':'no check done yet'}
+                else:
+                    answer=view.answer(request)
+            except (ValueError,TypeError,AttributeError) as e:
+                answer={'error':'bad request: {}'.format(e)}
+            self.wfile.write(json.dumps(answer).encode("utf-8")+b'\n')
+
+class StatusServer(socketserver.ThreadingUnixStreamServer):
+    """ Read-only status queries of a long running jobcheck
+
+    The server answers on status_socket(path) in a thread of its own,
+    from the last StatusView published by the checks.
+
+    Args:
+        path (string): the root of the job folders
+
+    """
+    daemon_threads=True
+
+    def __init__(self,path):
+        self.view=None
+        address=status_socket(path)
+        if os.path.exists(address):
+            if query_status(path,{'query':'summary'}) is not None:
+                raise OSError(errno.EADDRINUSE,'another jobcheck serves',
+                              address)
+            # left by a jobcheck that is gone
+            os.remove(address)
+        socketserver.ThreadingUnixStreamServer.__init__(self,address,
+                                                        _StatusHandler)
+        self.thread=threading.Thread(target=self.serve_forever,daemon=True)
+        self.thread.start()
+
+    def publish(self,qjobs,fjobs):
+        self.view=StatusView(qjobs,fjobs)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+# the root of the tree served from folder or above, None if none is
+def find_status_root(folder):
+    folder=os.path.abspath(folder)
+    while True:
+        if os.path.exists(status_socket(folder)):
+            return folder
+        parent=os.path.dirname(folder)
+        if parent==folder:
+            return None
+        folder=parent
+
+def query_status(path,request,timeout=5):
+    """ Ask the status server of a tree
+
+    Args:
+        path (string): the root of the job folders
+        request (dict): the query, see StatusView.answer
+        timeout (float): seconds to wait for the answer
+
+    Returns:
+        dict: the answer, None if no server answers
+
+    """
+    try:
+        with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(status_socket(path))
+            sock.sendall(json.dumps(request).encode("utf-8")+b'\n')
+            with sock.makefile('rb') as fp:
+                line=fp.readline()
+    except OSError:
+        return None
+    return json.loads(line.decode("utf-8")) if line else None
+
 ############################
 # run main function
 ##############################
 if __name__=='__main__':
 
+    import argparse
+    parser=argparse.ArgumentParser(description='Check and resubmit the '
+                                   'jobs in the folders below here')
+    parser.add_argument('--full-rescan',action='store_true',
+                        help='read all the folders again in the first '
+                        'check, ignoring the saved scan state')
+    parser.add_argument('--ignore',action='append',default=[],
+                        metavar='PATTERN',
+                        help='skip the folders matching this glob pattern, '
+                        'can be given several times')
+    parser.add_argument('--max-depth',type=int,default=None,
+                        help='how deep to look for job folders')
+    parser.add_argument('--nested',action='store_true',
+                        help='also look for job folders inside job folders')
+    parser.add_argument('--workers',type=int,default=1,
+                        help='number of threads reading the job folders')
+    parser.add_argument('--qsub-workers',type=int,default=4,
+                        help='how many qsub can run at the same time')
+    parser.add_argument('--qsub-rate',type=float,default=10,
+                        help='at most this many qsub a second, 0 for no '
+                        'limit')
+    parser.add_argument('--timeout',type=float,default=300,
+                        help='seconds before a qstat, qsub or qdel call is '
+                        'given up')
+    parser.add_argument('--profile',default=None,metavar='FILE',
+                        help='save a cProfile dump of the first check, '
+                        'kill -USR1 profiles the next check')
+    parser.add_argument('--watch',action='store_true',
+                        help='check the folders when their job files '
+                        'change (Linux inotify) instead of every 10 minutes')
+    parser.add_argument('--reconcile',type=float,default=30,
+                        help='minutes between two full checks in watch '
+                        'and daemon mode')
+    parser.add_argument('--poll',type=float,default=60,
+                        help='seconds between two queue checks in watch '
+                        'mode')
+    parser.add_argument('--queue',action='append',default=[],
+                        metavar='NAME=LIMIT',
+                        help='allow at most LIMIT of our jobs in the queue '
+                        'NAME (default {}), can be given several '
+                        'times'.format(','.join('{}={}'.format(*x) for x in
+                                                default_limits.items())))
+    parser.add_argument('--rebuild-manifest',action='store_true',
+                        help='walk the tree once, write the list of job '
+                        'folders into {} and stop; the checks then read '
+                        'the list instead of walking'.format(manifest_file))
+    parser.add_argument('--register',nargs='+',default=[],metavar='FOLDER',
+                        help='add job folders to the manifest above them '
+                        'and stop')
+    parser.add_argument('--array',action='store_true',
+                        help='submit the folders with the same queue and job '
+                        'script options as one array job (qsub -t)')
+    parser.add_argument('--local-cores',type=int,default=0,metavar='N',
+                        help='run the jobs expected to end before they '
+                        'would start in the queue here, on at most N '
+                        'cores (default: none)')
+    parser.add_argument('--query',nargs='+',metavar='QUERY',
+                        help='ask the running jobcheck and stop: folder '
+                        '[FOLDER], status STATUS, job ID or summary')
+    parser.add_argument('--no-server',action='store_true',
+                        help='do not answer --query on a Unix socket in '
+                        'watch, daemon and scheduled mode')
+    parser.add_argument('--query-cache',type=float,default=0,
+                        metavar='SECONDS',
+                        help='share the qstat answers with the other '
+                        'jobchecks of this user on this machine for '
+                        'SECONDS, 0 to always ask the queue (default: 0)')
+    parser.add_argument('--query-cache-dir',default=None,metavar='PATH',
+                        help='the folder of the shared qstat answers, '
+                        'owned by the user with mode 0700 '
+                        '(default: /dev/shm/jobcheck-<uid>)')
+    parser.add_argument('--root',action='append',default=[],
+                        dest='roots',metavar='PATH',
+                        help='check the job folders below this root too, '
+                        'can be given several times; the roots share one '
+                        'queue query and one report')
+    parser.add_argument('--processes',type=int,default=None,
+                        help='check the roots with this many processes, '
+                        'all the cores if not given')
+    parser.add_argument('--daemon',action='store_true',
+                        help='keep the state in memory and check again '
+                        'sooner when jobs are about to end, later when '
+                        'idle')
+    parser.add_argument('--min-interval',type=float,default=60,
+                        help='shortest seconds between two checks in '
+                        'daemon mode')
+    parser.add_argument('--max-interval',type=float,default=1800,
+                        help='longest seconds between two checks in '
+                        'daemon mode')
+    args=parser.parse_args()
+    limits={}
+    for item in args.queue:
+        name,sep,limit=item.rpartition('=')
+        if not sep or not name or not limit.isdigit():
+            parser.error('--queue needs NAME=LIMIT, not '+item)
+        limits[name]=int(limit)
+    if (args.roots or args.processes) and (args.watch or args.daemon):
+        parser.error('--root and --processes do not work with --watch '
+                     'or --daemon')
+
     class common:
         path='./'
+        server=None
+        full=args.full_rescan
+        options={'stop_at_job':not args.nested,'ignore':args.ignore,
+                 'max_depth':args.max_depth,'workers':args.workers,
+                 'qsub_workers':args.qsub_workers,'qsub_rate':args.qsub_rate,
+                 'timeout':args.timeout,'limits':limits,
+                 'array':args.array,'local_cores':args.local_cores}
 
     def my_job():
-        oldstdout = sys.stdout
-        sys.stdout = open('currentjob.txt', 'w+')
-        main(common.path)
-        sys.stdout.flush()
-        sys.stdout=oldstdout
+        with tick_lock(common.path) as locked:
+            if not locked:
+                print('jobcheck: another check is running, skip this tick',
+                      file=sys.stderr)
+                return
+            run_check()
+
+    def run_check():
+        try:
+            if args.roots or args.processes:
+                options=dict(common.options)
+                options.pop('workers')
+                qjobs,fjobs=profiled(run_to_file,'currentjob.txt',
+                                     main_sharded,[common.path]+args.roots,
+                                     args.processes,common.full,**options)
+            else:
+                qjobs,fjobs=profiled(run_to_file,'currentjob.txt',main,
+                                     common.path,common.full,
+                                     **common.options)
+            write_status(status_file('currentjob.txt'),qjobs,fjobs)
+            if common.server is not None:
+                common.server.publish(qjobs,fjobs)
+        finally:
+            METRICS.write(common.path)
+        common.full=False
+
+    # kill -USR1 profiles the next check, in every mode
+    PROFILE_FILE=args.profile
+    def profile_next(signum,frame):
+        global PROFILE_FILE
+        PROFILE_FILE=os.path.join(common.path,'jobcheck_{}.prof'.format(
+            datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    signal.signal(signal.SIGUSR1,profile_next)
 
     common.path=os.getcwd()
+    if args.query_cache>0:
+        try:
+            QUERY_CACHE=QueryCache(args.query_cache_dir,args.query_cache)
+        except OSError as e:
+            print('jobcheck: no qstat cache, {}'.format(e),file=sys.stderr)
+    if args.rebuild_manifest:
+        for root in [common.path]+args.roots:
+            n=rebuild_manifest(root,not args.nested,args.ignore,
+                               args.max_depth)
+            print('{}: {} job folders'.format(
+                os.path.join(root,manifest_file),n))
+        sys.exit(0)
+    if args.register:
+        missing=[folder for folder in args.register 
+                 if find_manifest(folder) is None]
+        for folder in missing:
+            print('jobcheck: no {} above {}, run --rebuild-manifest '
+                  'first'.format(manifest_file,folder),file=sys.stderr)
+        print('{} folders added'.format(register_folders(args.register)))
+        sys.exit(1 if missing else 0)
+    if args.query:
+        kind,arg=args.query[0],(args.query[1:] or [None])[0]
+        request={'query':kind}
+        if kind=='folder':
+            request['folder']=os.path.abspath(arg or '.')
+        elif kind=='status':
+            request['status']=arg
+        elif kind=='job':
+            request['idx']=arg
+        root=find_status_root(request.get('folder',common.path))
+        answer=query_status(root,request) if root else None
+        if answer is None:
+            print('jobcheck: no running jobcheck answers here',
+                  file=sys.stderr)
+            sys.exit(2)
+        if 'error' in answer:
+            print('jobcheck: '+answer['error'],file=sys.stderr)
+            sys.exit(1)
+        if kind=='summary':
+            print(answer['text'].rstrip())
+        elif kind=='status':
+            print('\n'.join(answer['folders']))
+        else:
+            print(json.dumps(answer,indent=1))
+        sys.exit(0)
+    if not args.no_server:
+        try:
+            common.server=StatusServer(common.path)
+        except OSError as e:
+            print('jobcheck: no status server, {}'.format(e),
+                  file=sys.stderr)
+    if args.watch:
+        watch(common.path,os.path.join(common.path,'currentjob.txt'),
+              reconcile=args.reconcile*60,poll=args.poll,full=common.full,
+              server=common.server,**common.options)
+        sys.exit(0)
+    if args.daemon:
+        daemon(common.path,os.path.join(common.path,'currentjob.txt'),
+               min_interval=args.min_interval,
+               max_interval=args.max_interval,
+               reconcile=args.reconcile*60,full=common.full,
+               server=common.server,**common.options)
+        sys.exit(0)
+
+    from apscheduler.schedulers.blocking import BlockingScheduler
     scheduler = BlockingScheduler()
     scheduler.add_job(my_job, 'interval', minutes=10,
                       next_run_time=datetime.datetime.now())
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+""" Benchmark of jobcheck2 on a fake cluster
+
+A tree of simulation folders is generated in a temporary folder and
+stub qstat, qsub, qdel and myq commands are put on PATH.  The stubs keep
+the queue in a json file and can be slowed down to look like a busy
+qmaster.  Everything runs offline, e.g.
+
+    python jobcheck_bench.py --sizes 1000 10000 --latency 0.05
+
+prints one line for each scenario and size.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import datetime
+import statistics
+import contextlib
+
+import jobcheck2
+
+##################################################
+# stub scheduler commands
+###################################################
+# one script for all the commands, it looks at the name it is run with
+STUB='''#!{python}
+import sys,os,json,time,fcntl,datetime
+state_file=os.environ['JOBCHECK_BENCH_STATE']
+time.sleep(float(os.environ.get('JOBCHECK_BENCH_LATENCY','0')))
+cmd=os.path.basename(sys.argv[0])
+args=sys.argv[1:]
+lock=open(state_file+'.lock','a')
+fcntl.flock(lock,fcntl.LOCK_EX)
+with open(state_file) as fp:
+    state=json.load(fp)
+jobs=state['jobs']
+out=sys.stdout.write
+
+def save():
+    with open(state_file+'.tmp','w') as fp:
+        json.dump(state,fp)
+    os.replace(state_file+'.tmp',state_file)
+
+# the tasks field of qstat for a list of task numbers
+def task_range(tasks):
+    if tasks==list(range(tasks[0],tasks[-1]+1)):
+        return '%d-%d:1' % (tasks[0],tasks[-1])
+    return ','.join(str(task) for task in tasks)
+
+# a job is [idx,status,queue,submit time,start time,workdir,name], an
+# array job has the list of its waiting tasks as well
+if cmd=='qstat' and '-j' in args:
+    wanted=set(args[args.index('-j')+1].split(','))
+    found=set()
+    for job in jobs:
+        if job[0] in wanted:
+            found.add(job[0])
+            out('='*62+'\\n')
+            out('job_number:                 %s\\n' % job[0])
+            out('job_name:                   %s\\n' % job[6])
+            out('sge_o_workdir:              %s\\n' % job[5])
+    if wanted-found:
+        sys.stderr.write('Following jobs do not exist:\\n')
+        sys.exit(1)
+elif cmd=='qstat':
+    out("<?xml version='1.0'?>\\n<job_info>\\n")
+    for running in (True,False):
+        out('  <queue_info>\\n' if running else '  <job_info>\\n')
+        for job in jobs:
+            if (job[1] in ('r','t','dr'))!=running:
+                continue
+            out('    <job_list state="%s">\\n' %
+                ('running' if running else 'pending'))
+            out('      <JB_job_number>%s</JB_job_number>\\n' % job[0])
+            out('      <JB_name>%s</JB_name>\\n' % job[6])
+            out('      <state>%s</state>\\n' % job[1])
+            if running:
+                out('      <JAT_start_time>%s</JAT_start_time>\\n' % job[4])
+                out('      <queue_name>%s@compute-1</queue_name>\\n' % job[2])
+            else:
+                out('      <JB_submission_time>%s</JB_submission_time>\\n'
+                    % job[3])
+                out('      <queue_name></queue_name>\\n')
+            out('      <slots>1</slots>\\n')
+            if len(job)>7:
+                out('      <tasks>%s</tasks>\\n' % task_range(job[7]))
+            out('      <hard_req_queue>%s</hard_req_queue>\\n' % job[2])
+            out('    </job_list>\\n')
+        out('  </queue_info>\\n' if running else '  </job_info>\\n')
+    out('</job_info>\\n')
+elif cmd=='myq':
+    out('job-ID  prior   name       user         state submit/start at     '
+        'queue                          slots ja-task-ID \\n')
+    out('-'*110+'\\n')
+    for job in jobs:
+        t=job[4] if job[1]=='r' else job[3]
+        t=datetime.datetime.strptime(t,'%Y-%m-%dT%H:%M:%S')
+        queue=job[2]+'@compute-1' if job[1]=='r' else ''
+        out('%7s 0.50000 %-10s bench        %-5s %-19s %-30s %5s\\n' % (
+            job[0],job[6][:10],job[1],t.strftime('%m/%d/%Y %H:%M:%S'),
+            queue,1))
+elif cmd=='qsub':
+    queue='all.q'
+    workdir=os.getcwd()
+    script=None
+    name=None
+    tasks=None
+    i=0
+    # the arguments after the script are its own
+    while i<len(args):
+        if args[i]=='-q':
+            queue=args[i+1]
+        elif args[i]=='-wd':
+            workdir=args[i+1]
+        elif args[i]=='-N':
+            name=args[i+1]
+        elif args[i]=='-t':
+            first,last=args[i+1].split(':')[0].split('-')
+            tasks=list(range(int(first),int(last)+1))
+        elif args[i].startswith('-'):
+            pass
+        else:
+            script=args[i]
+            break
+        i+=2
+    idx=str(state['next'])
+    state['next']+=1
+    now=datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    name=name or os.path.basename(script)
+    if tasks:
+        jobs.append([idx,'qw',queue,now,now,workdir,name,tasks])
+        save()
+        out('Your job-array %s.%s ("%s") has been submitted\\n' % (
+            idx,task_range(tasks),name))
+    else:
+        jobs.append([idx,'qw',queue,now,now,workdir,name])
+        save()
+        out('Your job %s ("%s") has been submitted\\n' % (idx,name))
+elif cmd=='qdel':
+    wanted=set(a for arg in args if not arg.startswith('-')
+               for a in arg.split(','))
+    by_idx=dict((job[0],job) for job in jobs)
+    missing=False
+    # a task of an array job is job.task
+    for idx in sorted(wanted):
+        number,dot,task=idx.partition('.')
+        job=by_idx.get(number)
+        if job is None or task and (len(job)==7 or
+                                    int(task) not in job[7]):
+            out('denied: job "%s" does not exist\\n' % idx)
+            missing=True
+            continue
+        if task:
+            job[7].remove(int(task))
+        else:
+            job[1]='deleted'
+        out('bench has registered the job %s for deletion\\n' % idx)
+    state['jobs']=[job for job in jobs
+                   if job[1]!='deleted' and (len(job)==7 or job[7])]
+    save()
+    if missing:
+        sys.exit(1)
+'''
+
+def install_stubs(bindir):
+    os.makedirs(bindir,exist_ok=True)
+    stub=os.path.join(bindir,'sge_stub')
+    with open(stub,'w') as fp:
+        fp.write(STUB.format(python=sys.executable))
+    os.chmod(stub,0o755)
+    for name in ('qstat','qsub','qdel','myq'):
+        link=os.path.join(bindir,name)
+        if not os.path.exists(link):
+            os.symlink(stub,link)
+
+##################################################
+# generated folder trees
+###################################################
+default_mix={'d':0.6,'nd':0.05,'r':0.15,'qw':0.1,'qw_old':0.03,
+             'Eqw':0.04,'p':0.03}
+
+def parse_mix(text):
+    mix={}
+    for item in text.split(','):
+        key,value=item.split('=')
+        if key not in default_mix:
+            raise argparse.ArgumentTypeError('unknown state '+key)
+        mix[key]=float(value)
+    return mix
+
+def info_stamp(t):
+    return t.strftime('%a %b %d %H:%M:%S CST %Y')
+
+def make_tree(root,n,mix=None,queue_extra=0,outputs=0,seed=1):
+    """ Build n simulation folders below root and the queue they imply
+
+    Args:
+        root (string): an empty folder
+        n (int): number of simulation folders
+        mix (dict): state -> fraction, the states are d, nd, r, qw,
+            qw_old (waiting more than an hour), Eqw and p (two jobs)
+        queue_extra (int): queued jobs of other folders
+        outputs (int): output files in a fields folder of each simulation
+
+    Returns:
+        dict: the stub queue state
+
+    """
+    mix=mix or default_mix
+    rnd=random.Random(seed)
+    states=list(mix)
+    weights=[mix[x] for x in states]
+    now=datetime.datetime.now()
+    fmt='%Y-%m-%dT%H:%M:%S'
+    jobs=[]
+    next_idx=[100000]
+
+    def new_job(status,folder,wait,name):
+        idx=str(next_idx[0])
+        next_idx[0]+=1
+        submit=now-datetime.timedelta(seconds=wait)
+        start=now-datetime.timedelta(seconds=wait//2)
+        jobs.append([idx,status,'all.q',submit.strftime(fmt),
+                     start.strftime(fmt),folder,name])
+        return idx
+
+    for i in range(n):
+        kind=rnd.choices(states,weights)[0]
+        folder=os.path.join(root,'campaign%02d'%(i%20),'sweep%03d'%(i//1000),
+                            'sim%06d'%i)
+        os.makedirs(folder)
+        name='dwt%06d.job'%i
+        with open(os.path.join(folder,name),'w') as fp:
+            fp.write('#!/bin/bash\n#$ -cwd\nsleep 1\n')
+        if outputs:
+            fields=os.path.join(folder,'fields')
+            os.makedirs(fields)
+            for k in range(outputs):
+                open(os.path.join(fields,'ez-%06d.h5'%k),'w').close()
+
+        if kind=='d' or kind=='nd':
+            idx=str(50000+i)
+        elif kind=='r' or kind=='p':
+            idx=new_job('r',folder,7200,name)
+            if kind=='p':
+                new_job('r',folder,7200,name)
+        elif kind=='qw':
+            idx=new_job('qw',folder,600,name)
+        elif kind=='qw_old':
+            idx=new_job('qw',folder,3*3600,name)
+        else:
+            idx=new_job('Eqw',folder,600,name)
+
+        with open(os.path.join(folder,'job.begin'),'w') as fp:
+            fp.write('Your job %s ("%s") has been submitted\n' % (idx,name))
+        btime=now-datetime.timedelta(hours=2)
+        if kind in ('d','r','p'):
+            with open(os.path.join(folder,'job.info'),'w') as fp:
+                fp.write('+'*20+'\n'+info_stamp(btime)+'\n'+idx+' compute-1\n')
+                if kind=='d':
+                    etime=now-datetime.timedelta(minutes=10)
+                    fp.write('-'*20+'\n'+info_stamp(etime)+'\n'+idx+'\n')
+        if kind=='d':
+            with open(os.path.join(folder,'job.done'),'w') as fp:
+                fp.write('%s done\n' % idx)
+            open(os.path.join(folder,'out.dat'),'w').close()
+
+    for i in range(queue_extra):
+        new_job(rnd.choice(('r','qw')),'/elsewhere/sim%06d'%i,600,'other.job')
+    return {'next':next_idx[0],'jobs':jobs}
+
+##################################################
+# scenarios
+###################################################
+class Bench:
+    def __init__(self,workdir,latency,mix,queue_extra,outputs,options):
+        self.workdir=workdir
+        self.latency=latency
+        self.mix=mix
+        self.queue_extra=queue_extra
+        self.outputs=outputs
+        self.options=options
+        self.bindir=os.path.join(workdir,'bin')
+        self.state_file=os.path.join(workdir,'queue.json')
+        install_stubs(self.bindir)
+        os.environ['PATH']=self.bindir+os.pathsep+os.environ['PATH']
+        os.environ['JOBCHECK_BENCH_STATE']=self.state_file
+        os.environ['JOBCHECK_BENCH_LATENCY']=str(latency)
+
+    # a fresh tree and queue of n folders
+    def setup(self,n):
+        root=os.path.join(self.workdir,'tree')
+        shutil.rmtree(root,ignore_errors=True)
+        os.makedirs(root)
+        state=make_tree(root,n,self.mix,self.queue_extra,self.outputs)
+        with open(self.state_file,'w') as fp:
+            json.dump(state,fp)
+        jobcheck2._parse_cache.clear()
+        return root
+
+    def myq(self,n):
+        self.setup(n)
+        t0=time.perf_counter()
+        qjobs=jobcheck2.Qjob_list()
+        qjobs.myq()
+        return time.perf_counter()-t0
+
+    def walk(self,n):
+        root=self.setup(n)
+        qjobs=jobcheck2.Qjob_list()
+        qjobs.myq()
+        fjobs=jobcheck2.Fjob_list()
+        fjobs.backends=jobcheck2.make_backends(
+            root,qsub_rate=self.options['qsub_rate'],
+            array=self.options['array'])
+        t0=time.perf_counter()
+        with quiet():
+            fjobs.walk_and_build(root,qjobs,workers=self.options['workers'])
+        return time.perf_counter()-t0
+
+    def main(self,n):
+        root=self.setup(n)
+        t0=time.perf_counter()
+        with quiet():
+            jobcheck2.main(root,**self.options)
+        return time.perf_counter()-t0
+
+    # a second tick on the same tree, the scan state is used
+    def main_warm(self,n):
+        root=self.setup(n)
+        with quiet():
+            jobcheck2.main(root,**self.options)
+        jobcheck2._parse_cache.clear()
+        t0=time.perf_counter()
+        with quiet():
+            jobcheck2.main(root,**self.options)
+        return time.perf_counter()-t0
+
+scenarios=('myq','walk','main','main_warm')
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull,'w') as fp:
+        with contextlib.redirect_stdout(fp):
+            yield
+
+############################
+# run the benchmark
+##############################
+def main():
+    parser=argparse.ArgumentParser(description='Benchmark jobcheck2 on a '
+                                   'generated tree and a fake scheduler')
+    parser.add_argument('--sizes',type=int,nargs='+',
+                        default=[1000,10000,100000],
+                        help='numbers of simulation folders')
+    parser.add_argument('--scenarios',nargs='+',choices=scenarios,
+                        default=list(scenarios))
+    parser.add_argument('--repeat',type=int,default=3,
+                        help='runs of each scenario, the best one counts')
+    parser.add_argument('--latency',type=float,default=0.0,
+                        help='seconds each stub command sleeps')
+    parser.add_argument('--mix',type=parse_mix,default=default_mix,
+                        help='state fractions, e.g. d=0.6,nd=0.1,r=0.3')
+    parser.add_argument('--queue-extra',type=int,default=0,
+                        help='queued jobs that belong to no folder here')
+    parser.add_argument('--outputs',type=int,default=0,
+                        help='output files in each simulation folder')
+    parser.add_argument('--workers',type=int,default=1,
+                        help='passed to jobcheck2')
+    parser.add_argument('--qsub-rate',type=float,default=0,
+                        help='passed to jobcheck2, no limit by default')
+    parser.add_argument('--array',action='store_true',
+                        help='passed to jobcheck2')
+    parser.add_argument('--workdir',default=None,
+                        help='where to build the trees, a temporary '
+                        'folder by default')
+    parser.add_argument('--json',action='store_true',
+                        help='print the results as json lines')
+    args=parser.parse_args()
+
+    workdir=args.workdir or tempfile.mkdtemp(prefix='jobcheck_bench_')
+    options={'workers':args.workers,'qsub_rate':args.qsub_rate,
+             'array':args.array}
+    bench=Bench(workdir,args.latency,args.mix,args.queue_extra,args.outputs,
+                options)
+    if not args.json:
+        print('{:10} {:>8} {:>10} {:>10}'.format('scenario','folders',
+                                                 'best (s)','median (s)'))
+    try:
+        for n in args.sizes:
+            for name in args.scenarios:
+                times=[getattr(bench,name)(n) for i in range(args.repeat)]
+                result={'scenario':name,'folders':n,'best':min(times),
+                        'median':statistics.median(times),
+                        'latency':args.latency,'workers':args.workers,
+                        'qsub_rate':args.qsub_rate,'array':args.array}
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print('{:10} {:>8} {:>10.3f} {:>10.3f}'.format(
+                        name,n,result['best'],result['median']))
+                sys.stdout.flush()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+if __name__=='__main__':
+    main()